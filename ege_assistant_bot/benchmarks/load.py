@@ -0,0 +1,270 @@
+"""Нагрузочный тест обработчиков бота без обращений к Telegram.
+
+Прогоняет настоящий граф хендлеров из ``create_dispatcher`` на
+синтетических апдейтах: каждый виртуальный студент проходит
+регистрацию, вход, сохранение баллов и их просмотр. Исходящие запросы
+к Bot API перехватывает ``RecordingSession``. Нужны Postgres с
+примененными миграциями (из .env) и Redis: кэши студентов, предметов и
+ответов /view_scores работают через Redis всегда. ``--memory-storage``
+переносит в память процесса только FSM, чтобы исключить его из замера.
+
+Запуск из каталога ege_assistant_bot::
+
+    python benchmarks/load.py --students 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+from collections import defaultdict
+from dataclasses import replace
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from common.speedups import run
+from config.config import get_config, setup_logging
+from database.models import Student, StudentScore, Subject, student_score_history
+from dispatcher.dispatcher import create_dispatcher
+from metrics.metrics import current_timings, instrument_engine, reset_timings
+
+# Диапазон telegram_id виртуальных студентов, не пересекается с реальными
+TELEGRAM_ID_BASE = 9_000_000_000_000
+
+FLOWS = {
+    "register": ("start", "register", "first_name", "last_name"),
+    "login": ("login",),
+    "enter_scores": ("enter_scores", "subject", "score"),
+    "view_scores": ("view_scores",),
+}
+
+
+class RecordingSession(BaseSession):
+    """Сессия Bot API, которая запоминает запросы вместо отправки."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.requests: defaultdict[str, int] = defaultdict(int)
+        self._message_ids = itertools.count(1)
+
+    async def make_request(
+            self,
+            bot: Bot,
+            method: TelegramMethod[Any],
+            timeout: int | None = None
+    ) -> Any:
+        self.requests[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return Message(
+            message_id=next(self._message_ids),
+            date=0,
+            chat=Chat(id=getattr(method, "chat_id", 0), type="private"),
+            text=getattr(method, "text", None)
+        )
+
+    async def stream_content(self, *args: Any, **kwargs: Any):
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class Results:
+
+    def __init__(self) -> None:
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.queries: defaultdict[str, list[int]] = defaultdict(list)
+        self.updates = 0
+
+    def add(self, step: str, latency: float, queries: int) -> None:
+        self.latencies[step].append(latency)
+        self.queries[step].append(queries)
+        self.updates += 1
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = max(0, int(round(percent / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def _update(update_id: int, telegram_id: int, text: str) -> dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": telegram_id, "type": "private"},
+            "from": {"id": telegram_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+async def _run_student(
+        dispatcher: Dispatcher,
+        bot: Bot,
+        number: int,
+        subject: str,
+        results: Results,
+        update_ids: itertools.count
+) -> None:
+    telegram_id = TELEGRAM_ID_BASE + number
+    steps = (
+        ("start", "/start"),
+        ("register", "/register"),
+        ("first_name", "Иван"),
+        ("last_name", "Иванов"),
+        ("login", "/login"),
+        ("enter_scores", "/enter_scores"),
+        ("subject", subject),
+        ("score", str(50 + number % 49)),
+        ("view_scores", "/view_scores"),
+    )
+    for step, text in steps:
+        reset_timings()
+        started = time.perf_counter()
+        await dispatcher.feed_raw_update(
+            bot=bot,
+            update=_update(next(update_ids), telegram_id, text)
+        )
+        results.add(step, time.perf_counter() - started, current_timings()["db_queries"])
+
+
+async def _prepare_db(dispatcher: Dispatcher, subjects: list[str]) -> None:
+    async with dispatcher["session_pool"]() as session:
+        await session.execute(
+            insert(Subject)
+            .values([{"name": name} for name in subjects])
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+        await session.commit()
+    await _cleanup(dispatcher)
+    await dispatcher["subject_catalog"].load()
+
+
+async def _cleanup(dispatcher: Dispatcher) -> None:
+    """Удаляет виртуальных студентов из БД и их записи из кэшей Redis.
+
+    Иначе следующий запуск получил бы из кэша id удаленных студентов.
+    """
+    students = select(Student.id).where(Student.telegram_id >= TELEGRAM_ID_BASE)
+    async with dispatcher["session_pool"]() as session:
+        await session.execute(delete(StudentScore).where(StudentScore.student_id.in_(students)))
+        await session.execute(
+            delete(student_score_history).where(student_score_history.c.student_id.in_(students))
+        )
+        telegram_ids = (await session.execute(
+            delete(Student)
+            .where(Student.telegram_id >= TELEGRAM_ID_BASE)
+            .returning(Student.telegram_id)
+        )).scalars().all()
+        await session.commit()
+    await dispatcher["student_cache"].evict(*telegram_ids)
+    for telegram_id in telegram_ids:
+        await dispatcher["score_views"].invalidate(telegram_id)
+
+
+def _report(results: Results, elapsed: float, session: RecordingSession) -> None:
+    print("Обработано апдейтов: %s за %.2f с, %.0f апд/с" % (
+        results.updates, elapsed, results.updates / elapsed
+    ))
+    print("Запросы к Bot API: %s" % dict(session.requests))
+    print()
+    print("%-14s %10s %10s %10s %12s" % ("шаг", "p50, мс", "p99, мс", "max, мс", "SQL/апдейт"))
+    for flow, steps in FLOWS.items():
+        for step in steps:
+            latencies = results.latencies[step]
+            queries = results.queries[step]
+            print("%-14s %10.2f %10.2f %10.2f %12.2f" % (
+                step,
+                _percentile(latencies, 50) * 1000,
+                _percentile(latencies, 99) * 1000,
+                max(latencies) * 1000,
+                sum(queries) / len(queries)
+            ))
+        flow_queries = sum(sum(results.queries[step]) for step in steps)
+        students = len(results.queries[steps[0]])
+        print("%-14s SQL-запросов на студента: %.2f" % ("= " + flow, flow_queries / students))
+        print()
+
+
+async def main(args: argparse.Namespace) -> None:
+    config = get_config()
+    # Виртуальные студенты шлют апдейты без пауз, а RecordingSession
+    # не Telegram: лимиты частоты в обе стороны не нужны
+    bench_config = replace(
+        config,
+        metrics=replace(config.metrics, enabled=False),
+        throttling=replace(config.throttling, enabled=False),
+        sender=replace(config.sender, rate=1_000_000, chat_interval=0),
+        score_buffer=replace(config.score_buffer, enabled=args.score_buffer)
+    )
+    storage = None
+    if args.memory_storage:
+        storage = MemoryStorage()
+        bench_config = replace(bench_config, redis=replace(bench_config.redis, fsm_cache_size=0))
+    dispatcher = await create_dispatcher(bench_config, storage=storage)
+    for engine in dispatcher["session_router"].engines:
+        instrument_engine(engine)
+    session = RecordingSession(latency=args.send_latency)
+    bot = Bot(token=bench_config.tg_bot.token, session=session)
+    # Как при запуске бота: прогрев пулов, подписки кэшей, MessageSender и
+    # фоновые задания стартуют на startup, а на shutdown останавливаются,
+    # ScoreWriter дописывает баллы и закрываются пулы, Redis и FSM
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+    try:
+        subjects = bench_config.subjects.names.split(",")
+        await _prepare_db(dispatcher, subjects)
+
+        results = Results()
+        update_ids = itertools.count(1)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def run(number: int) -> None:
+            async with semaphore:
+                await _run_student(
+                    dispatcher, bot, number, subjects[number % len(subjects)], results, update_ids
+                )
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run(number) for number in range(args.students)))
+        elapsed = time.perf_counter() - started
+        await _cleanup(dispatcher)
+    finally:
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+
+    _report(results, elapsed, session)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--send-latency", type=float, default=0.0,
+        help="искусственная задержка ответа Bot API в секундах"
+    )
+    parser.add_argument(
+        "--score-buffer", action="store_true",
+        help="сохранять баллы пачками через ScoreWriter"
+    )
+    parser.add_argument(
+        "--memory-storage", action="store_true",
+        help="FSM в памяти процесса вместо Redis"
+    )
+    args = parser.parse_args()
+    setup_logging(get_config())
+    run(main(args), get_config().speedups)
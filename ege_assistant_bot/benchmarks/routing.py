@@ -0,0 +1,100 @@
+"""Микробенчмарк выбора хендлера для сообщения.
+
+Сравнивает обычный обсервер aiogram, который перебирает фильтры
+``F.text == "/команда"`` всех хендлеров по очереди, с
+``IndexedMessageObserver``, который берет кандидатов из словаря по
+тексту и состоянию. Хендлеры ничего не делают, FSM хранится в памяти,
+к Telegram и БД запросов нет: измеряется только диспетчеризация.
+
+Запуск из каталога ege_assistant_bot::
+
+    python benchmarks/routing.py --commands 10 50 200 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.filters import StateFilter
+from aiogram.fsm.state import default_state
+from aiogram.types import Update
+
+from routing.routing import IndexedMessageObserver, TextIs
+
+
+async def _noop(message: Any) -> None:
+    pass
+
+
+def _build(commands: int, indexed: bool) -> Dispatcher:
+    dispatcher = Dispatcher()
+    if indexed:
+        IndexedMessageObserver.install(dispatcher)
+    for number in range(commands):
+        text = "/command%s" % number
+        dispatcher.message.register(
+            _noop,
+            StateFilter(default_state),
+            TextIs(text) if indexed else F.text == text
+        )
+    # Как warning_* хендлеры: ловит все, что не подошло выше
+    dispatcher.message.register(_noop)
+    return dispatcher
+
+
+def _update(text: str) -> Update:
+    return Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    })
+
+
+async def _measure(dispatcher: Dispatcher, bot: Bot, update: Update, iterations: int) -> float:
+    for _ in range(min(iterations, 100)):
+        await dispatcher.feed_update(bot, update)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await dispatcher.feed_update(bot, update)
+    return (time.perf_counter() - started) / iterations
+
+
+async def main(args: argparse.Namespace) -> None:
+    bot = Bot(token="42:bench")
+    cases = (
+        ("первая", lambda commands: "/command0"),
+        ("последняя", lambda commands: "/command%s" % (commands - 1)),
+        ("текст", lambda commands: "произвольный текст"),
+    )
+    print("%8s %-10s %14s %14s %8s" % (
+        "команд", "сообщение", "фильтры, мкс", "индекс, мкс", "x"
+    ))
+    for commands in args.commands:
+        plain = _build(commands, indexed=False)
+        indexed = _build(commands, indexed=True)
+        for name, text in cases:
+            update = _update(text(commands))
+            plain_cost = await _measure(plain, bot, update, args.iterations)
+            indexed_cost = await _measure(indexed, bot, update, args.iterations)
+            print("%8s %-10s %14.1f %14.1f %8.1f" % (
+                commands, name, plain_cost * 1e6, indexed_cost * 1e6,
+                plain_cost / indexed_cost
+            ))
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--commands", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--iterations", type=int, default=500)
+    asyncio.run(main(parser.parse_args()))
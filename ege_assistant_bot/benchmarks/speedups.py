@@ -0,0 +1,147 @@
+"""Микробенчмарк цикла событий и библиотек JSON.
+
+Апдейт проходит тот же путь, что и в боте: JSON апдейта разбирается
+выбранной библиотекой, хендлер читает и пишет данные FSM, хранилище
+сериализует их как RedisStorage, ответ Bot API с клавиатурой готовится
+и разбирается методами сессии aiogram. Сети, Redis и БД нет:
+измеряется процессорное время на апдейт для каждой комбинации цикла
+событий и JSON. Не установленные библиотеки пропускаются.
+
+Запуск из каталога ege_assistant_bot::
+
+    python benchmarks/speedups.py --updates 20000
+"""
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.methods import TelegramMethod
+from aiogram.types import KeyboardButton, Message, ReplyKeyboardMarkup
+
+from common.speedups import event_loop_factory, json_codec
+
+KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=subject)]
+        for subject in ("Математика", "Русский язык", "Физика", "Информатика")
+    ],
+    resize_keyboard=True
+)
+
+FSM_DATA = {
+    "login": True,
+    "telegram_id": 1,
+    "subject": "Математика",
+    "first_name": "Иван",
+    "last_name": "Иванов",
+}
+
+
+def _message(text: str) -> dict[str, Any]:
+    return {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+
+
+UPDATE = json.dumps({"update_id": 1, "message": _message("/view_scores")}, ensure_ascii=False)
+RESPONSE = json.dumps({"ok": True, "result": _message("Математика: 61\nФизика: 55")}, ensure_ascii=False)
+
+
+class CodecSession(BaseSession):
+    """Готовит запрос и разбирает ответ, как AiohttpSession, без сети."""
+
+    async def make_request(
+            self,
+            bot: Bot,
+            method: TelegramMethod[Any],
+            timeout: int | None = None
+    ) -> Any:
+        files: dict[str, Any] = {}
+        for value in method.model_dump(warnings=False).values():
+            self.prepare_value(value, bot=bot, files=files)
+        response = self.check_response(bot, method, status_code=200, content=RESPONSE)
+        return response.result
+
+    async def stream_content(self, *args: Any, **kwargs: Any):
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class CodecStorage(BaseStorage):
+    """FSM в памяти, сериализующий данные, как RedisStorage."""
+
+    def __init__(self, json_loads: Any, json_dumps: Any) -> None:
+        self.json_loads = json_loads
+        self.json_dumps = json_dumps
+        self._states: dict[StorageKey, str | None] = {}
+        self._data: dict[StorageKey, str] = {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._states[key] = getattr(state, "state", state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self._states.get(key)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        self._data[key] = self.json_dumps(data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        value = self._data.get(key)
+        return self.json_loads(value) if value is not None else {}
+
+    async def close(self) -> None:
+        pass
+
+
+async def _handler(message: Message, state: FSMContext) -> None:
+    await state.get_data()
+    await state.update_data(FSM_DATA)
+    await message.answer("Выбери предмет", reply_markup=KEYBOARD)
+
+
+async def _measure(codec: str, updates: int) -> float:
+    json_loads, json_dumps = json_codec(codec)
+    dispatcher = Dispatcher(storage=CodecStorage(json_loads, json_dumps))
+    dispatcher.message.register(_handler)
+    bot = Bot(token="42:bench", session=CodecSession(json_loads=json_loads, json_dumps=json_dumps))
+    for _ in range(min(updates, 500)):
+        await dispatcher.feed_raw_update(bot, json_loads(UPDATE))
+    started = time.process_time()
+    for _ in range(updates):
+        await dispatcher.feed_raw_update(bot, json_loads(UPDATE))
+    return (time.process_time() - started) / updates
+
+
+def main(args: argparse.Namespace) -> None:
+    loops = [name for name in ("asyncio", "uvloop") if name == "asyncio" or importlib.util.find_spec(name)]
+    codecs = [name for name in ("json", "orjson", "msgspec") if name == "json" or importlib.util.find_spec(name)]
+    print("%-8s %-8s %14s %8s" % ("цикл", "JSON", "CPU, мкс/апд", "x"))
+    baseline = None
+    for loop, codec in itertools.product(loops, codecs):
+        cost = asyncio.run(_measure(codec, args.updates), loop_factory=event_loop_factory(loop))
+        baseline = baseline or cost
+        print("%-8s %-8s %14.1f %8.2f" % (loop, codec, cost * 1e6, baseline / cost))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000)
+    main(parser.parse_args())
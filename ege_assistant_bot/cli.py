@@ -0,0 +1,418 @@
+"""Массовый импорт и экспорт баллов студентов, рассылки.
+
+Формат строки (CSV с заголовком или JSONL):
+telegram_id, first_name, last_name, subject, score.
+Имя и фамилия при импорте необязательны, если студент уже
+зарегистрирован. Предметы берутся из таблицы subject. Строки без
+предмета или с баллом вне диапазона, который принимает бот,
+пропускаются.
+
+Рассылка отправляет сообщение всем студентам. Прогресс хранится в
+Redis под именем рассылки: после сбоя достаточно запустить команду
+с тем же именем.
+
+detach-history отсоединяет месячные секции истории баллов старше
+указанного месяца без блокировки записи. Месяц не может быть позже
+текущего за вычетом HISTORY_RETENTION_MONTHS: секции текущего и
+будущих месяцев принимают записи. Отсоединенные таблицы остаются в
+БД: их можно выгрузить в архив и удалить вручную.
+
+invalidate-subjects сообщает процессам бота, что таблица subject
+изменилась: они перечитают справочник предметов, не дожидаясь
+SUBJECTS_CACHE_TTL.
+
+Примеры::
+
+    python cli.py import scores.csv
+    python cli.py export scores.jsonl --format jsonl
+    python cli.py export - > scores.csv
+    python cli.py broadcast results-2024 --text "Опубликованы результаты, /enter_scores"
+    python cli.py detach-history --before 2024-09
+    python cli.py invalidate-subjects
+"""
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator, TextIO
+
+from aiogram import Bot
+from redis.asyncio import Redis
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from common.speedups import create_bot_session, run
+from config.config import get_config, setup_logging
+from database.db import create_pool
+from database.models import Student, StudentScore, Subject
+from services.broadcast import Broadcast
+from services.score_views import ScoreViewCache
+from services.scores import is_valid_score
+from services.sender import MessageSender
+from services.students import StudentIdentityCache
+from services.subjects import publish_invalidation
+
+logger = logging.getLogger("bot")
+
+FIELDS = ("telegram_id", "first_name", "last_name", "subject", "score")
+
+EXPORT_BATCH_SIZE = 5000
+EVICT_BATCH_SIZE = 1000
+
+CREATE_IMPORT_TABLE = text("""
+    CREATE TEMP TABLE import_score (
+        line bigint NOT NULL,
+        telegram_id bigint NOT NULL,
+        first_name varchar(100),
+        last_name varchar(100),
+        subject varchar(50) NOT NULL,
+        score integer NOT NULL
+    ) ON COMMIT DROP
+""")
+
+# Имена обновляются только если изменились: по возвращенным telegram_id
+# сбрасывается кэш студентов. Новые записи (xmax = 0) в кэше быть не могут
+UPSERT_STUDENTS = text("""
+    INSERT INTO student (telegram_id, first_name, last_name)
+    SELECT DISTINCT ON (telegram_id) telegram_id, first_name, last_name
+    FROM import_score
+    WHERE first_name IS NOT NULL AND last_name IS NOT NULL
+    ORDER BY telegram_id, line DESC
+    ON CONFLICT (telegram_id) DO UPDATE
+    SET first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name
+    WHERE student.first_name IS DISTINCT FROM EXCLUDED.first_name
+       OR student.last_name IS DISTINCT FROM EXCLUDED.last_name
+    RETURNING telegram_id, xmax = 0 AS inserted
+""")
+
+# Для повторяющихся пар студент-предмет побеждает последняя строка файла
+UPSERT_SCORES = text("""
+    INSERT INTO student_score (student_id, subject_id, score)
+    SELECT DISTINCT ON (student.id, subject.id) student.id, subject.id, import_score.score
+    FROM import_score
+    JOIN student ON student.telegram_id = import_score.telegram_id
+    JOIN subject ON subject.name = import_score.subject
+    ORDER BY student.id, subject.id, import_score.line DESC
+    ON CONFLICT ON CONSTRAINT _student_subject_uc DO UPDATE
+    SET score = EXCLUDED.score
+""")
+
+COUNT_UNRESOLVED = text("""
+    SELECT
+        count(*) FILTER (WHERE student.id IS NULL) AS unknown_students,
+        count(*) FILTER (WHERE subject.id IS NULL) AS unknown_subjects
+    FROM import_score
+    LEFT JOIN student ON student.telegram_id = import_score.telegram_id
+    LEFT JOIN subject ON subject.name = import_score.subject
+""")
+
+# Секции истории, целиком лежащие до указанной даты. Секция текущего
+# месяца не выбирается при любой дате: в нее идут новые записи
+HISTORY_PARTITIONS = text("""
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'student_score_history'
+      AND child.relname < 'student_score_history_' || to_char(CAST(:before AS date), 'YYYY_MM')
+      AND child.relname < 'student_score_history_' || to_char(now(), 'YYYY_MM')
+    ORDER BY child.relname
+""")
+
+EXPORT_SCORES = select(
+    Student.telegram_id,
+    Student.first_name,
+    Student.last_name,
+    Subject.name,
+    StudentScore.score
+).join(
+    StudentScore, StudentScore.student_id == Student.id
+).join(
+    Subject, Subject.id == StudentScore.subject_id
+).order_by(Student.telegram_id, Subject.name)
+
+
+@contextmanager
+def _open(path: str, mode: str) -> Iterator[TextIO]:
+    if path == "-":
+        yield sys.stdin if mode == "r" else sys.stdout
+        return
+    with open(path, mode, encoding="utf-8", newline="") as file:
+        yield file
+
+
+def _detect_format(path: str, fmt: str | None) -> str:
+    if fmt:
+        return fmt
+    return "jsonl" if Path(path).suffix in (".jsonl", ".json") else "csv"
+
+
+def _read_rows(file: TextIO, fmt: str) -> Iterator[dict[str, Any]]:
+    if fmt == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _month(value: str) -> date:
+    try:
+        return datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("ожидается месяц в формате ГГГГ-ММ")
+
+
+def _latest_detachable(retention_months: int) -> date:
+    """Самый поздний месяц, до которого можно отсоединить секции."""
+    today = date.today()
+    months = today.year * 12 + today.month - 1 - retention_months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+class ImportStats:
+
+    def __init__(self) -> None:
+        self.rows = 0
+        self.skipped = 0
+
+
+async def _records(
+        rows: Iterator[dict[str, Any]],
+        stats: ImportStats
+) -> AsyncIterator[tuple]:
+    for line, row in enumerate(rows, start=1):
+        try:
+            score = int(row["score"])
+            if not is_valid_score(score):
+                raise ValueError("score out of range: %s" % score)
+            if not row.get("subject"):
+                raise ValueError("subject is missing")
+            record = (
+                line,
+                int(row["telegram_id"]),
+                row.get("first_name") or None,
+                row.get("last_name") or None,
+                row["subject"],
+                score,
+            )
+        except (KeyError, TypeError, ValueError) as error:
+            stats.skipped += 1
+            logger.warning("Строка %s пропущена: %s", line, error)
+            continue
+        stats.rows += 1
+        yield record
+
+
+async def _copy_rows(
+        connection: AsyncConnection,
+        rows: Iterator[dict[str, Any]],
+        stats: ImportStats
+) -> None:
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        "import_score",
+        records=_records(rows, stats),
+        columns=("line", *FIELDS)
+    )
+
+
+async def _invalidate_caches(telegram_ids: list[int], scores_changed: bool) -> None:
+    if not telegram_ids and not scores_changed:
+        return
+    config = get_config()
+    redis = Redis.from_url(config.redis.url_db)
+    cache = StudentIdentityCache(
+        redis=redis,
+        ttl=config.student_cache.ttl,
+        max_size=config.student_cache.max_size,
+        channel=config.student_cache.invalidate_channel
+    )
+    score_views = ScoreViewCache(
+        redis=redis,
+        ttl=config.score_views.ttl,
+        max_size=config.score_views.max_size,
+        fill_delay=config.db.replica_delay()
+    )
+    try:
+        for start in range(0, len(telegram_ids), EVICT_BATCH_SIZE):
+            await cache.evict(*telegram_ids[start:start + EVICT_BATCH_SIZE])
+        if scores_changed:
+            # Все готовые ответы /view_scores устаревают одной командой
+            await score_views.invalidate_all()
+    finally:
+        await redis.aclose()
+
+
+async def import_scores(engine: AsyncEngine, path: str, fmt: str) -> None:
+    stats = ImportStats()
+    started = time.perf_counter()
+    with _open(path, "r") as file:
+        async with engine.begin() as connection:
+            # Транзакцию начинает SQLAlchemy, COPY идет в ней же,
+            # временная таблица удаляется при commit
+            await connection.execute(CREATE_IMPORT_TABLE)
+            await _copy_rows(connection, _read_rows(file, fmt), stats)
+            students = (await connection.execute(UPSERT_STUDENTS)).all()
+            scores = await connection.execute(UPSERT_SCORES)
+            unresolved = (await connection.execute(COUNT_UNRESOLVED)).one()
+    updated = [row.telegram_id for row in students if not row.inserted]
+    await _invalidate_caches(updated, scores_changed=scores.rowcount > 0)
+    logger.info(
+        "Импорт: строк %s, пропущено %s, новых студентов %s, обновлено %s, "
+        "сохранено баллов %s, без студента %s, без предмета %s, %.2f с",
+        stats.rows, stats.skipped, len(students) - len(updated), len(updated),
+        scores.rowcount, unresolved.unknown_students, unresolved.unknown_subjects,
+        time.perf_counter() - started
+    )
+
+
+async def export_scores(engine: AsyncEngine, path: str, fmt: str) -> None:
+    started = time.perf_counter()
+    exported = 0
+    with _open(path, "w") as file:
+        writer = csv.writer(file) if fmt == "csv" else None
+        if writer:
+            writer.writerow(FIELDS)
+        async with engine.connect() as connection:
+            # stream использует серверный курсор: в памяти одна пачка строк
+            result = await connection.stream(
+                EXPORT_SCORES.execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            async for rows in result.partitions():
+                if writer:
+                    writer.writerows(rows)
+                else:
+                    file.writelines(
+                        json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + "\n"
+                        for row in rows
+                    )
+                exported += len(rows)
+    logger.info(
+        "Экспорт: строк %s, %.2f с", exported, time.perf_counter() - started
+    )
+
+
+async def broadcast(
+        engine: AsyncEngine,
+        name: str,
+        text: str | None,
+        restart: bool
+) -> None:
+    config = get_config()
+    redis = Redis.from_url(config.redis.url_db)
+    bot = Bot(token=config.tg_bot.token, session=create_bot_session(config.speedups))
+    sender = MessageSender(
+        rate=config.broadcast.rate,
+        chat_interval=config.sender.chat_interval,
+        max_pending=config.sender.max_pending,
+        max_in_flight=config.sender.max_in_flight,
+        max_retries=config.sender.max_retries,
+        shutdown_timeout=config.sender.shutdown_timeout
+    )
+    job = Broadcast(
+        name=name,
+        engine=engine,
+        redis=redis,
+        sender=sender,
+        rate=config.broadcast.rate,
+        batch_size=config.broadcast.batch_size,
+        progress_interval=config.broadcast.progress_interval,
+        checkpoint_ttl=config.broadcast.checkpoint_ttl
+    )
+    await sender.start(bot)
+    try:
+        if restart:
+            await job.reset()
+        await job.run(text)
+    finally:
+        await sender.stop()
+        await bot.session.close()
+        await redis.aclose()
+
+
+async def detach_history(engine: AsyncEngine, before: date) -> None:
+    # DETACH ... CONCURRENTLY нельзя выполнять внутри транзакции
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        partitions = (await connection.execute(
+            HISTORY_PARTITIONS, {"before": before}
+        )).scalars().all()
+        for partition in partitions:
+            started = time.perf_counter()
+            await connection.exec_driver_sql(
+                'ALTER TABLE student_score_history DETACH PARTITION "%s" CONCURRENTLY'
+                % partition
+            )
+            logger.info(
+                "Секция %s отсоединена, %.2f с", partition, time.perf_counter() - started
+            )
+    if not partitions:
+        logger.info("Нет секций истории старше %s", before.strftime("%Y-%m"))
+
+
+async def invalidate_subjects() -> None:
+    config = get_config()
+    redis = Redis.from_url(config.redis.url_db)
+    try:
+        await publish_invalidation(redis, config.subjects.invalidate_channel)
+    finally:
+        await redis.aclose()
+    logger.info("Сигнал сброса справочника предметов отправлен")
+
+
+async def main(args: argparse.Namespace) -> None:
+    config = get_config()
+    pool = create_pool(config.db.create_url_db(), **config.db.create_engine_options())
+    engine = pool.kw["bind"]
+    try:
+        if args.command == "broadcast":
+            await broadcast(engine, args.name, args.text, args.restart)
+        elif args.command == "detach-history":
+            await detach_history(engine, args.before)
+        elif args.command == "invalidate-subjects":
+            await invalidate_subjects()
+        elif args.command == "import":
+            await import_scores(engine, args.path, _detect_format(args.path, args.format))
+        else:
+            await export_scores(engine, args.path, _detect_format(args.path, args.format))
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("import", "export"):
+        scores_parser = commands.add_parser(command)
+        scores_parser.add_argument("path", help="файл CSV/JSONL или - для stdin/stdout")
+        scores_parser.add_argument("--format", choices=("csv", "jsonl"))
+    broadcast_parser = commands.add_parser("broadcast")
+    broadcast_parser.add_argument("name", help="имя рассылки, под ним хранится прогресс")
+    broadcast_parser.add_argument("--text", help="текст, при продолжении берется из Redis")
+    broadcast_parser.add_argument(
+        "--restart", action="store_true",
+        help="начать рассылку заново, забыв сохраненный прогресс"
+    )
+    detach_parser = commands.add_parser("detach-history")
+    detach_parser.add_argument(
+        "--before", required=True, type=_month,
+        help="месяц ГГГГ-ММ, секции до него отсоединяются"
+    )
+    commands.add_parser("invalidate-subjects")
+    args = parser.parse_args()
+    config = get_config()
+    if args.command == "detach-history":
+        latest = _latest_detachable(max(config.history.retention_months, 0))
+        if args.before > latest:
+            parser.error(
+                "--before не может быть позже %s (HISTORY_RETENTION_MONTHS=%s)"
+                % (latest.strftime("%Y-%m"), config.history.retention_months)
+            )
+    setup_logging(config)
+    run(main(args), config.speedups)
@@ -4,5 +4,7 @@ menu = [
     BotCommand(command="/login", description="Войти в аккаунт"),
     BotCommand(command="/register", description="Регистрация"),
     BotCommand(command="/enter_scores", description="Сохранить баллы"),
-    BotCommand(command="/view_scores", description="Посмотреть сохраненные баллы")
+    BotCommand(command="/view_scores", description="Посмотреть сохраненные баллы"),
+    BotCommand(command="/stats", description="Сравнить баллы с другими участниками"),
+    BotCommand(command="/history", description="Как менялись баллы")
 ]
@@ -1,10 +1,18 @@
 import logging
 import pytz
 from datetime import datetime
+from functools import lru_cache
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+
+@lru_cache(maxsize=128)
+def _moscow_timetuple(seconds: int):
+    return datetime.fromtimestamp(seconds, MOSCOW_TZ).timetuple()
 
 
 class CustomFormatter(logging.Formatter):
     def converter(self, timestamp):
-        tz = pytz.timezone('Europe/Moscow')
-        dt = datetime.fromtimestamp(timestamp, tz)
-        return dt.timetuple()
+        # asctime выводится с точностью до секунды, поэтому записи
+        # одной секунды используют одно и то же значение из кэша
+        return _moscow_timetuple(int(timestamp))
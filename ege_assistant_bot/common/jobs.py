@@ -0,0 +1,72 @@
+import asyncio
+import contextlib
+import logging
+from typing import Any, Awaitable, Callable, Coroutine
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger("bot")
+
+
+class BackgroundTask:
+    """Корутина, которая работает в фоне от start до stop."""
+
+    def __init__(self, factory: Callable[[], Coroutine[Any, Any, None]]) -> None:
+        self._factory = factory
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._factory())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+
+class PeriodicJob(BackgroundTask):
+    """Выполняет ``job`` раз в ``interval`` секунд.
+
+    Если задан ``lock_key``, задание выполняет только один процесс из
+    всех реплик: тот, кто захватил ключ в Redis на время интервала.
+    Ошибка задания пишется в лог с ``error_message`` и не останавливает
+    следующие запуски. С ``delay_first`` первый запуск - через интервал.
+    """
+
+    def __init__(
+            self,
+            job: Callable[[], Awaitable[None]],
+            interval: float,
+            error_message: str,
+            redis: Redis | None = None,
+            lock_key: str | None = None,
+            delay_first: bool = False
+    ) -> None:
+        super().__init__(self._run)
+        self._job = job
+        self._interval = interval
+        self._error_message = error_message
+        self._redis = redis
+        self._lock_key = lock_key
+        self._delay_first = delay_first
+
+    async def _acquire(self) -> bool:
+        if self._lock_key is None:
+            return True
+        return bool(await self._redis.set(
+            self._lock_key, 1, nx=True, ex=max(int(self._interval), 1)
+        ))
+
+    async def _run(self) -> None:
+        if self._delay_first:
+            await asyncio.sleep(self._interval)
+        while True:
+            try:
+                if await self._acquire():
+                    await self._job()
+            except Exception:
+                logger.exception(self._error_message)
+            await asyncio.sleep(self._interval)
@@ -0,0 +1,19 @@
+import json
+import logging
+
+from common.datetime_formats import CustomFormatter
+
+
+class JsonFormatter(CustomFormatter):
+    """Форматирует запись лога как одну строку JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
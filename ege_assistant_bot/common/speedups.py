@@ -0,0 +1,69 @@
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Coroutine, TypeVar
+
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from config.config import Speedups
+
+logger = logging.getLogger("bot")
+
+T = TypeVar("T")
+
+JsonLoads = Callable[[str | bytes], Any]
+JsonDumps = Callable[[Any], str]
+
+
+def json_codec(name: str) -> tuple[JsonLoads, JsonDumps]:
+    """Функции loads/dumps выбранной библиотеки JSON.
+
+    aiogram и RedisStorage ждут от dumps строку, поэтому байты orjson и
+    msgspec декодируются. Если библиотека не установлена, используется
+    стандартный json.
+    """
+    if name == "json":
+        return json.loads, json.dumps
+    try:
+        if name == "orjson":
+            import orjson
+
+            def dumps(obj: Any) -> str:
+                # Как json.dumps: целые ключи словарей становятся строками
+                return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+            return orjson.loads, dumps
+        if name == "msgspec":
+            import msgspec
+
+            encoder = msgspec.json.Encoder()
+            decoder = msgspec.json.Decoder()
+            return decoder.decode, lambda obj: encoder.encode(obj).decode()
+    except ImportError:
+        logger.warning("%s не установлен, используется стандартный json", name)
+        return json.loads, json.dumps
+    raise ValueError("unknown JSON codec: %s" % name)
+
+
+def event_loop_factory(name: str) -> Callable[[], asyncio.AbstractEventLoop] | None:
+    """Фабрика цикла событий, None - стандартный цикл asyncio."""
+    if name == "asyncio":
+        return None
+    if name != "uvloop":
+        raise ValueError("unknown event loop: %s" % name)
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("uvloop не установлен, используется цикл asyncio")
+        return None
+    return uvloop.new_event_loop
+
+
+def run(main: Coroutine[Any, Any, T], speedups: Speedups) -> T:
+    return asyncio.run(main, loop_factory=event_loop_factory(speedups.event_loop))
+
+
+def create_bot_session(speedups: Speedups) -> AiohttpSession:
+    """Сессия Bot API, разбирающая ответы выбранной библиотекой JSON."""
+    json_loads, json_dumps = json_codec(speedups.json)
+    return AiohttpSession(json_loads=json_loads, json_dumps=json_dumps)
@@ -0,0 +1,26 @@
+import logging
+import time
+
+logger = logging.getLogger("bot")
+
+
+class StartupTimer:
+    """Замеряет этапы запуска бота и пишет их в лог одной строкой."""
+
+    def __init__(self, started: float) -> None:
+        self._started = started
+        self._last = started
+        self.stages: list[tuple[str, float]] = []
+
+    def mark(self, stage: str) -> None:
+        """Завершает этап ``stage``: он длился с предыдущей отметки."""
+        now = time.perf_counter()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def report(self) -> None:
+        logger.info(
+            "Бот запущен за %.0f мс: %s",
+            (self._last - self._started) * 1000,
+            ", ".join("%s %.0f мс" % (stage, seconds * 1000) for stage, seconds in self.stages)
+        )
@@ -1,10 +1,15 @@
+import atexit
 import logging.config
 
 from dataclasses import dataclass
 from environs import Env
+from functools import cache
+from logging.handlers import QueueListener
 from pathlib import Path
+from uuid import uuid4
 
 from common.datetime_formats import CustomFormatter
+from common.log_formats import JsonFormatter
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -16,36 +21,208 @@ class DatabaseConfig:
     db_user: str          # Username пользователя базы данных
     db_password: str      # Пароль к базе данных
     db_port: str      # Пароль к базе данных
+    pool_size: int              # Постоянных соединений в пуле
+    max_overflow: int           # Дополнительных соединений сверх pool_size
+    pool_timeout: float         # Сколько ждать свободного соединения, сек
+    pool_recycle: int           # Пересоздавать соединения старше N сек, -1 - никогда
+    pool_pre_ping: bool         # Проверять соединение перед выдачей из пула
+    pool_warmup: int            # Сколько соединений открыть при старте
+    statement_cache_size: int   # Кэш подготовленных выражений на соединение
+    query_cache_size: int       # Кэш скомпилированных SQL-выражений SQLAlchemy
+    pgbouncer: bool             # Совместимость с PgBouncer в режиме transaction
+    replica_hosts: list[str]    # Реплики для чтения, host или host:port
+    replica_max_lag: float      # Реплика с большим отставанием не используется, сек
+    replica_check_interval: float   # Как часто проверять реплики, сек
+    read_your_writes: float     # Сколько читать с основной БД после записи чата, сек
 
-    def create_url_db(self):
+    def create_url_db(self, host: str | None = None):
+        port = self.db_port
+        if host is None:
+            host = self.db_host
+        elif ":" in host:
+            host, port = host.rsplit(":", 1)
         url = "%s://%s:%s@%s:%s/%s" % (
             "postgresql+asyncpg", self.db_user, self.db_password,
-            self.db_host, int(self.db_port), self.database
+            host, int(port), self.database
         )
         return url
 
+    def replica_delay(self) -> float:
+        """Сколько реплика может не видеть записанные данные, сек."""
+        if not self.replica_hosts:
+            return 0.0
+        return self.replica_max_lag + self.replica_check_interval
+
+    def create_engine_options(self):
+        connect_args = {
+            "statement_cache_size": self.statement_cache_size,
+            "prepared_statement_cache_size": self.statement_cache_size,
+        }
+        if self.pgbouncer:
+            # PgBouncer может отдать другое серверное соединение,
+            # поэтому подготовленные выражения не кэшируются
+            connect_args = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: "__asyncpg_%s__" % uuid4(),
+            }
+        return {
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+            "pool_recycle": self.pool_recycle,
+            "pool_pre_ping": self.pool_pre_ping,
+            "query_cache_size": self.query_cache_size,
+            "connect_args": connect_args,
+        }
+
 
 @dataclass
 class RedisDatabase:
     url_db: str
+    fsm_cache_size: int   # Размер LRU-кэша FSM в памяти процесса, 0 - без кэша
 
 
 @dataclass
 class TgBot:
-    token: str            # Токен для доступа к телеграм-боту
+    token: str                   # Токен для доступа к телеграм-боту
+    drop_pending_updates: bool   # Сбрасывать накопившиеся апдейты при запуске
+
+
+@dataclass
+class Webhook:
+    enabled: bool            # Получать апдейты через вебхук вместо polling
+    base_url: str            # Публичный адрес, на который Telegram шлет апдейты
+    path: str                # Путь обработчика вебхука
+    secret: str              # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+    host: str                # Адрес, на котором слушает aiohttp-сервер
+    port: int                # Порт aiohttp-сервера
+    max_concurrency: int     # Максимум одновременно обрабатываемых апдейтов
+    shutdown_timeout: float  # Сколько ждать обработки апдейтов при остановке
+
+    def __post_init__(self):
+        # Без секрета aiogram не проверяет заголовок, и апдейты может
+        # прислать кто угодно
+        if self.enabled and not (self.base_url and self.secret):
+            raise ValueError(
+                "WEBHOOK_BASE_URL and WEBHOOK_SECRET are required when WEBHOOK_ENABLED is set"
+            )
+
+    def create_url(self):
+        return self.base_url.rstrip("/") + self.path
 
 
 @dataclass
 class Subjects:
     names: list[str]
+    cache_ttl: int              # Время жизни кэша предметов в секундах
+    invalidate_channel: str     # Redis-канал для сброса кэша предметов
+
+
+@dataclass
+class Workers:
+    count: int               # Число процессов-обработчиков, 1 - без шардирования
+    shutdown_timeout: float  # Сколько ждать завершения процессов при остановке
+
+
+@dataclass
+class StudentCache:
+    ttl: int                    # Время жизни записи о студенте в секундах
+    max_size: int               # Размер L1-кэша в памяти процесса
+    invalidate_channel: str     # Redis-канал для сброса записей о студентах
+
+
+@dataclass
+class ScoreViews:
+    ttl: int                    # Время жизни готового ответа /view_scores в секундах
+    max_size: int               # Размер L1-кэша в памяти процесса
+
+
+@dataclass
+class ScoreBuffer:
+    enabled: bool               # Записывать баллы пачками вместо commit на каждый
+    max_rows: int               # Сколько строк копить до записи
+    max_delay: float            # Сколько ждать следующих строк, сек
+
+
+@dataclass
+class History:
+    months_ahead: int           # На сколько месяцев вперед создавать секции
+    partition_interval: int     # Как часто проверять секции истории, сек
+    retention_months: int       # Сколько прошлых месяцев нельзя отсоединить
+
+
+@dataclass
+class Stats:
+    refresh_interval: int       # Период обновления статистики баллов в секундах
+
+
+@dataclass
+class Throttling:
+    enabled: bool               # Ограничивать частоту сообщений от одного чата
+    rate: float                 # Сообщений в секунду от чата
+    burst: int                  # Сколько сообщений чат может отправить подряд
+    command_rate: float         # Вызовов в секунду одной команды от чата
+    command_burst: int          # Сколько раз подряд можно вызвать команду
+    max_delay: float            # Дольше этого апдейт не ждет, а отбрасывается
+    local_cache_size: int       # Сколько пустых корзин помнить в процессе
+
+
+@dataclass
+class Sender:
+    rate: float                 # Сообщений в секунду от бота на все процессы вместе с рассылками
+    chat_interval: float        # Минимальная пауза между сообщениями в один чат
+    max_pending: int            # Размер очереди, при заполнении хендлеры ждут
+    max_in_flight: int          # Одновременных запросов к Telegram
+    max_retries: int            # Повторов при сетевых ошибках и ошибках сервера
+    shutdown_timeout: float     # Сколько ждать отправки очереди при остановке
+
+
+@dataclass
+class Broadcast:
+    rate: float                 # Сообщений в секунду, на это время вычитается из SENDER_RATE
+    batch_size: int             # Получателей в пачке, после пачки сохраняется прогресс
+    progress_interval: float    # Как часто писать прогресс в лог, сек
+    checkpoint_ttl: int         # Сколько хранить прогресс рассылки в Redis, сек
+
+
+@dataclass
+class Logs:
+    format: str                 # Формат логов: text или json
+
+
+@dataclass
+class Metrics:
+    enabled: bool         # Собирать метрики этапов обработки апдейтов
+    host: str             # Адрес сервера метрик
+    port: int             # Порт сервера метрик, обработчики занимают следующие
+
+
+@dataclass
+class Speedups:
+    event_loop: str       # Цикл событий: asyncio или uvloop
+    json: str             # JSON для Bot API и FSM: json, orjson или msgspec
 
 
 @dataclass
 class Config:
     tg_bot: TgBot
+    webhook: Webhook
+    workers: Workers
     db: DatabaseConfig
     redis: RedisDatabase
     subjects: Subjects
+    student_cache: StudentCache
+    score_views: ScoreViews
+    score_buffer: ScoreBuffer
+    history: History
+    stats: Stats
+    throttling: Throttling
+    sender: Sender
+    broadcast: Broadcast
+    logs: Logs
+    metrics: Metrics
+    speedups: Speedups
 
 
 def load_config(path: Path | None = None) -> Config:
@@ -55,52 +232,171 @@ def load_config(path: Path | None = None) -> Config:
 
     return Config(
         tg_bot=TgBot(
-            token=env("BOT_TOKEN")
+            token=env("BOT_TOKEN"),
+            drop_pending_updates=env.bool("DROP_PENDING_UPDATES", False)
+        ),
+        webhook=Webhook(
+            enabled=env.bool("WEBHOOK_ENABLED", False),
+            base_url=env("WEBHOOK_BASE_URL", ""),
+            path=env("WEBHOOK_PATH", "/webhook"),
+            secret=env("WEBHOOK_SECRET", ""),
+            host=env("WEBHOOK_HOST", "0.0.0.0"),
+            port=env.int("WEBHOOK_PORT", 8080),
+            max_concurrency=env.int("WEBHOOK_MAX_CONCURRENCY", 100),
+            shutdown_timeout=env.float("WEBHOOK_SHUTDOWN_TIMEOUT", 30.0)
+        ),
+        workers=Workers(
+            count=env.int("WORKERS", 1),
+            shutdown_timeout=env.float("WORKERS_SHUTDOWN_TIMEOUT", 30.0)
         ),
         db=DatabaseConfig(
             database=env("POSTGRES_DB"),
             db_host=env("POSTGRES_HOST"),
             db_port=env("POSTGRES_PORT"),
             db_user=env("POSTGRES_USER"),
-            db_password=env("POSTGRES_PASSWORD")
+            db_password=env("POSTGRES_PASSWORD"),
+            pool_size=env.int("POSTGRES_POOL_SIZE", 10),
+            max_overflow=env.int("POSTGRES_MAX_OVERFLOW", 10),
+            pool_timeout=env.float("POSTGRES_POOL_TIMEOUT", 30.0),
+            pool_recycle=env.int("POSTGRES_POOL_RECYCLE", 1800),
+            pool_pre_ping=env.bool("POSTGRES_POOL_PRE_PING", False),
+            pool_warmup=env.int("POSTGRES_POOL_WARMUP", 5),
+            statement_cache_size=env.int("POSTGRES_STATEMENT_CACHE_SIZE", 100),
+            query_cache_size=env.int("POSTGRES_QUERY_CACHE_SIZE", 500),
+            pgbouncer=env.bool("POSTGRES_PGBOUNCER", False),
+            replica_hosts=env.list("POSTGRES_REPLICA_HOSTS", []),
+            replica_max_lag=env.float("POSTGRES_REPLICA_MAX_LAG", 5.0),
+            replica_check_interval=env.float("POSTGRES_REPLICA_CHECK_INTERVAL", 5.0),
+            read_your_writes=env.float("POSTGRES_READ_YOUR_WRITES", 10.0)
         ),
         redis=RedisDatabase(
-            url_db=env("REDIS_LOCATION")
+            url_db=env("REDIS_LOCATION"),
+            fsm_cache_size=env.int("FSM_CACHE_SIZE", 0)
         ),
         subjects=Subjects(
-            names=env("SUBJECTS")
+            names=env("SUBJECTS"),
+            cache_ttl=env.int("SUBJECTS_CACHE_TTL", 600),
+            invalidate_channel=env(
+                "SUBJECTS_INVALIDATE_CHANNEL", "subjects:invalidate"
+            )
+        ),
+        student_cache=StudentCache(
+            ttl=env.int("STUDENT_CACHE_TTL", 86400),
+            max_size=env.int("STUDENT_CACHE_SIZE", 10000),
+            invalidate_channel=env(
+                "STUDENT_CACHE_INVALIDATE_CHANNEL", "students:invalidate"
+            )
+        ),
+        score_views=ScoreViews(
+            ttl=env.int("SCORE_VIEWS_TTL", 86400),
+            max_size=env.int("SCORE_VIEWS_CACHE_SIZE", 10000)
+        ),
+        score_buffer=ScoreBuffer(
+            enabled=env.bool("SCORE_BUFFER_ENABLED", False),
+            max_rows=env.int("SCORE_BUFFER_MAX_ROWS", 500),
+            max_delay=env.float("SCORE_BUFFER_MAX_DELAY", 0.005)
+        ),
+        history=History(
+            months_ahead=env.int("HISTORY_MONTHS_AHEAD", 3),
+            partition_interval=env.int("HISTORY_PARTITION_INTERVAL", 86400),
+            retention_months=env.int("HISTORY_RETENTION_MONTHS", 12)
+        ),
+        stats=Stats(
+            refresh_interval=env.int("STATS_REFRESH_INTERVAL", 300)
+        ),
+        throttling=Throttling(
+            enabled=env.bool("THROTTLING_ENABLED", True),
+            rate=env.float("THROTTLING_RATE", 1.0),
+            burst=env.int("THROTTLING_BURST", 5),
+            command_rate=env.float("THROTTLING_COMMAND_RATE", 0.2),
+            command_burst=env.int("THROTTLING_COMMAND_BURST", 3),
+            max_delay=env.float("THROTTLING_MAX_DELAY", 2.0),
+            local_cache_size=env.int("THROTTLING_LOCAL_CACHE_SIZE", 10000)
+        ),
+        sender=Sender(
+            rate=env.float("SENDER_RATE", 30.0),
+            chat_interval=env.float("SENDER_CHAT_INTERVAL", 1.0),
+            max_pending=env.int("SENDER_MAX_PENDING", 10000),
+            max_in_flight=env.int("SENDER_MAX_IN_FLIGHT", 30),
+            max_retries=env.int("SENDER_MAX_RETRIES", 3),
+            shutdown_timeout=env.float("SENDER_SHUTDOWN_TIMEOUT", 10.0)
+        ),
+        broadcast=Broadcast(
+            rate=env.float("BROADCAST_RATE", 20.0),
+            batch_size=env.int("BROADCAST_BATCH_SIZE", 1000),
+            progress_interval=env.float("BROADCAST_PROGRESS_INTERVAL", 10.0),
+            checkpoint_ttl=env.int("BROADCAST_CHECKPOINT_TTL", 604800)
+        ),
+        logs=Logs(
+            format=env("LOG_FORMAT", "text")
+        ),
+        metrics=Metrics(
+            enabled=env.bool("METRICS_ENABLED", False),
+            host=env("METRICS_HOST", "127.0.0.1"),
+            port=env.int("METRICS_PORT", 9100)
+        ),
+        speedups=Speedups(
+            event_loop=env("EVENT_LOOP", "asyncio"),
+            json=env("JSON_CODEC", "json")
         )
     )
 
 
 path_env = BASE_DIR / ".env"
 
-config = load_config(path_env)
 
+@cache
+def get_config() -> Config:
+    """Читает настройки из .env при первом обращении."""
+    return load_config(path_env)
 
-LOGGING = {
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        'mosayc': {
-            '()': CustomFormatter,
-            'format': '%(asctime)-15s %(levelname)-7s %(message)s',
-        }
-    },
-    'handlers': {
-        'console': {
-            'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
-            'formatter': 'mosayc'
-        }
-    },
-    'loggers': {
-        'bot': {
-            'handlers': ['console'],
-            'level': 'INFO',
-            'propagate': False,
+
+def create_logging_config(config: Config) -> dict:
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'mosayc': {
+                '()': CustomFormatter,
+                'format': '%(asctime)-15s %(levelname)-7s %(message)s',
+            },
+            'json': {
+                '()': JsonFormatter,
+            },
+        },
+        'handlers': {
+            'console': {
+                'level': 'DEBUG',
+                'class': 'logging.StreamHandler',
+                'formatter': 'json' if config.logs.format == 'json' else 'mosayc'
+            },
+            # Хендлеры бота только кладут запись в очередь, форматирование
+            # и запись в поток выполняет QueueListener в отдельном потоке
+            'queue': {
+                'class': 'logging.handlers.QueueHandler',
+                'handlers': ['console'],
+                'respect_handler_level': True,
+            },
         },
-    },
-}
+        'loggers': {
+            'bot': {
+                'handlers': ['queue'],
+                'level': 'INFO',
+                'propagate': False,
+            },
+        },
+    }
+
+
+_log_listener: QueueListener | None = None
+
 
-logging.config.dictConfig(LOGGING)
+def setup_logging(config: Config) -> None:
+    """Настраивает логирование один раз на процесс."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    logging.config.dictConfig(create_logging_config(config))
+    _log_listener = logging.getHandlerByName('queue').listener
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
@@ -1,4 +1,10 @@
-from sqlalchemy import URL
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any
+
+from sqlalchemy import URL, text
 from sqlalchemy.ext.asyncio import (
     AsyncEngine,
     AsyncSession,
@@ -6,9 +12,131 @@ from sqlalchemy.ext.asyncio import (
     create_async_engine,
 )
 
+from common.jobs import PeriodicJob
+
+logger = logging.getLogger("bot")
+
+# Отставание реплики в секундах. Если весь полученный WAL уже применен,
+# реплика догнала основную БД, даже если записей давно не было
+REPLICA_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
 
 def create_pool(
-        dsn: str | URL
+        dsn: str | URL,
+        **engine_options: Any
 ) -> async_sessionmaker[AsyncSession]:
-    engine: AsyncEngine = create_async_engine(url=dsn)
+    engine: AsyncEngine = create_async_engine(url=dsn, **engine_options)
     return async_sessionmaker(engine, expire_on_commit=False)
+
+
+async def warm_up_pool(engine: AsyncEngine, connections: int) -> None:
+    """Заранее открывает соединения, чтобы первые апдейты их не ждали."""
+    if connections <= 0:
+        return
+    opened = await asyncio.gather(
+        *(engine.connect().start() for _ in range(connections))
+    )
+    await asyncio.gather(*(connection.close() for connection in opened))
+
+
+class SessionRouter:
+    """Выбирает пул сессий: основной для записи, реплики для чтения.
+
+    Реплики выдаются по кругу, из ротации временно исключаются
+    недоступные и отстающие больше ``max_lag`` секунд. Чат, который
+    недавно писал в основную БД, ``read_your_writes`` секунд читает
+    из нее же, чтобы увидеть свои изменения. Без живых реплик все
+    запросы идут в основную БД.
+    """
+
+    def __init__(
+            self,
+            primary: async_sessionmaker[AsyncSession],
+            replicas: list[async_sessionmaker[AsyncSession]],
+            max_lag: float,
+            check_interval: float,
+            read_your_writes: float,
+            max_tracked: int = 100_000
+    ) -> None:
+        self.primary = primary
+        self.replicas = replicas
+        self._max_lag = max_lag
+        self._check_interval = check_interval
+        self._read_your_writes = read_your_writes
+        self._max_tracked = max_tracked
+        # Реплики попадают в ротацию после первой успешной проверки
+        self._healthy: list[async_sessionmaker[AsyncSession]] = []
+        self._next = 0
+        # chat_id -> до какого момента читать из основной БД, по возрастанию
+        self._written: OrderedDict[int, float] = OrderedDict()
+        self._checker = PeriodicJob(
+            self.check,
+            interval=check_interval,
+            error_message="Не удалось проверить реплики",
+            delay_first=True
+        )
+
+    @property
+    def engines(self) -> list[AsyncEngine]:
+        return [pool.kw["bind"] for pool in (self.primary, *self.replicas)]
+
+    def mark_written(self, chat_id: int) -> None:
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        self._written[chat_id] = now + self._read_your_writes
+        self._written.move_to_end(chat_id)
+        while self._written:
+            oldest, until = next(iter(self._written.items()))
+            if until > now and len(self._written) <= self._max_tracked:
+                break
+            del self._written[oldest]
+
+    def for_read(self, chat_id: int | None = None) -> async_sessionmaker[AsyncSession]:
+        if not self._healthy:
+            return self.primary
+        if chat_id is not None:
+            until = self._written.get(chat_id)
+            if until is not None:
+                if until > time.monotonic():
+                    return self.primary
+                del self._written[chat_id]
+        self._next = (self._next + 1) % len(self._healthy)
+        return self._healthy[self._next]
+
+    async def _is_healthy(self, pool: async_sessionmaker[AsyncSession]) -> bool:
+        engine = pool.kw["bind"]
+        try:
+            async with asyncio.timeout(self._check_interval):
+                async with engine.connect() as connection:
+                    lag = await connection.scalar(REPLICA_LAG)
+        except Exception as error:
+            logger.warning("Реплика %s недоступна: %r", engine.url.host, error)
+            return False
+        if lag is None or lag > self._max_lag:
+            # NULL - реплика еще не применила ни одной транзакции
+            logger.warning("Реплика %s отстает на %s с", engine.url.host, lag)
+            return False
+        return True
+
+    async def check(self) -> None:
+        results = await asyncio.gather(*(self._is_healthy(pool) for pool in self.replicas))
+        healthy = [pool for pool, ok in zip(self.replicas, results) if ok]
+        if len(healthy) != len(self._healthy):
+            logger.info("Реплик для чтения: %s из %s", len(healthy), len(self.replicas))
+        self._healthy = healthy
+
+    async def start(self) -> None:
+        if not self.replicas:
+            return
+        await self.check()
+        self._checker.start()
+
+    async def stop(self) -> None:
+        await self._checker.stop()
@@ -8,13 +8,13 @@ from sqlalchemy.ext.asyncio import async_engine_from_config
 from alembic import context
 
 from database.base import Base
-from config.config import config as c
+from config.config import get_config
 from database.models import Student, Subject, StudentScore
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
-config.set_main_option("sqlalchemy.url", str(c.db.create_url_db()))
+config.set_main_option("sqlalchemy.url", str(get_config().db.create_url_db()))
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
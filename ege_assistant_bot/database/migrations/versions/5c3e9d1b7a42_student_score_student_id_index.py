@@ -0,0 +1,42 @@
+"""student_score student_id index
+
+Revision ID: 5c3e9d1b7a42
+Revises: 1a880904b645
+Create Date: 2026-10-18 10:12:41.218533
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c3e9d1b7a42'
+down_revision: Union[str, None] = '1a880904b645'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Миграции применяются при старте бота: CONCURRENTLY не блокирует
+    # запись в student_score, пока строится индекс. Вне транзакции,
+    # иначе Postgres не разрешит CONCURRENTLY
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_student_score_student_id',
+            'student_score',
+            ['student_id'],
+            unique=False,
+            postgresql_include=['subject_id', 'score'],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_student_score_student_id',
+            table_name='student_score',
+            postgresql_concurrently=True
+        )
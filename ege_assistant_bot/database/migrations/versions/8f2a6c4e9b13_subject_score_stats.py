@@ -0,0 +1,52 @@
+"""subject_score_stats materialized view
+
+Revision ID: 8f2a6c4e9b13
+Revises: 5c3e9d1b7a42
+Create Date: 2026-10-18 14:05:12.604127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f2a6c4e9b13'
+down_revision: Union[str, None] = '5c3e9d1b7a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # score_counts[i] - число студентов с баллом i - 1 (от 0 до 100)
+    op.execute("""
+        CREATE MATERIALIZED VIEW subject_score_stats AS
+        SELECT
+            subject.id AS subject_id,
+            coalesce(sum(counts.students), 0)::integer AS students,
+            sum(grid.score * counts.students)::double precision
+                / nullif(sum(counts.students), 0) AS average,
+            array_agg(coalesce(counts.students, 0)::integer ORDER BY grid.score) AS score_counts
+        FROM subject
+        CROSS JOIN generate_series(0, 100) AS grid(score)
+        LEFT JOIN (
+            SELECT subject_id, score, count(*) AS students
+            FROM student_score
+            GROUP BY subject_id, score
+        ) AS counts
+            ON counts.subject_id = subject.id AND counts.score = grid.score
+        GROUP BY subject.id
+    """)
+    # Уникальный индекс нужен для REFRESH MATERIALIZED VIEW CONCURRENTLY
+    op.create_index(
+        'ix_subject_score_stats_subject_id',
+        'subject_score_stats',
+        ['subject_id'],
+        unique=True
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_subject_score_stats_subject_id', table_name='subject_score_stats')
+    op.execute("DROP MATERIALIZED VIEW subject_score_stats")
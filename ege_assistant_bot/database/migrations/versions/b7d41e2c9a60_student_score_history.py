@@ -0,0 +1,95 @@
+"""student_score_history partitioned by month
+
+Revision ID: b7d41e2c9a60
+Revises: 8f2a6c4e9b13
+Create Date: 2026-10-18 14:52:37.118402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d41e2c9a60'
+down_revision: Union[str, None] = '8f2a6c4e9b13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Без внешних ключей: история только дописывается, а проверка
+    # ключей удорожала бы каждую вставку. Секции без DEFAULT, иначе
+    # нельзя выполнить DETACH PARTITION ... CONCURRENTLY
+    op.execute("""
+        CREATE TABLE student_score_history (
+            student_id integer NOT NULL,
+            subject_id integer NOT NULL,
+            score integer NOT NULL,
+            created_at timestamptz NOT NULL DEFAULT now()
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("""
+        CREATE INDEX ix_student_score_history_created_at
+        ON student_score_history USING brin (created_at)
+    """)
+    # Для /history: строки одного студента, а не скан всей секции
+    op.execute("""
+        CREATE INDEX ix_student_score_history_student_id
+        ON student_score_history (student_id, subject_id, created_at)
+    """)
+
+    # Создает секции с текущего месяца на months месяцев вперед
+    op.execute("""
+        CREATE FUNCTION create_score_history_partitions(months integer) RETURNS void AS $$
+        DECLARE
+            month_start date;
+        BEGIN
+            FOR i IN 0..months LOOP
+                month_start := (date_trunc('month', now()) + make_interval(months => i))::date;
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF student_score_history '
+                    'FOR VALUES FROM (%L) TO (%L)',
+                    'student_score_history_' || to_char(month_start, 'YYYY_MM'),
+                    month_start,
+                    (month_start + interval '1 month')::date
+                );
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("SELECT create_score_history_partitions(3)")
+    # Текущие баллы становятся первой точкой истории
+    op.execute("""
+        INSERT INTO student_score_history (student_id, subject_id, score)
+        SELECT student_id, subject_id, score FROM student_score
+    """)
+
+    # Каждое сохранение балла, включая ON CONFLICT DO UPDATE и импорт,
+    # попадает в историю. Триггеры уровня оператора: пачка строк
+    # переносится одной вставкой из переходной таблицы
+    op.execute("""
+        CREATE FUNCTION record_student_score_history() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO student_score_history (student_id, subject_id, score)
+            SELECT student_id, subject_id, score FROM new_scores;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    for event in ('insert', 'update'):
+        op.execute(f"""
+            CREATE TRIGGER student_score_history_{event}
+            AFTER {event.upper()} ON student_score
+            REFERENCING NEW TABLE AS new_scores
+            FOR EACH STATEMENT EXECUTE FUNCTION record_student_score_history()
+        """)
+
+
+def downgrade() -> None:
+    for event in ('insert', 'update'):
+        op.execute(f"DROP TRIGGER student_score_history_{event} ON student_score")
+    op.execute("DROP FUNCTION record_student_score_history()")
+    op.execute("DROP FUNCTION create_score_history_partitions(integer)")
+    op.execute("DROP TABLE student_score_history")
@@ -0,0 +1,85 @@
+"""create_score_history_partitions checks pg_inherits
+
+Revision ID: d3f8a1c5e274
+Revises: b7d41e2c9a60
+Create Date: 2026-10-19 10:21:44.530918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3f8a1c5e274'
+down_revision: Union[str, None] = 'b7d41e2c9a60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Секция считается существующей, только если она подключена к
+    # student_score_history. Таблица с тем же именем, оставшаяся после
+    # DETACH, подключается обратно вместе с данными: без секции каждая
+    # запись в student_score падала бы на триггере истории
+    op.execute("""
+        CREATE OR REPLACE FUNCTION create_score_history_partitions(months integer) RETURNS void AS $$
+        DECLARE
+            month_start date;
+            partition_name text;
+            partition regclass;
+        BEGIN
+            FOR i IN 0..months LOOP
+                month_start := (date_trunc('month', now()) + make_interval(months => i))::date;
+                partition_name := 'student_score_history_' || to_char(month_start, 'YYYY_MM');
+                partition := to_regclass(quote_ident(partition_name));
+                CONTINUE WHEN partition IS NOT NULL AND EXISTS (
+                    SELECT 1 FROM pg_inherits
+                    WHERE inhparent = 'student_score_history'::regclass
+                      AND inhrelid = partition
+                );
+                IF partition IS NOT NULL THEN
+                    RAISE WARNING 'partition % is detached, attaching it back', partition_name;
+                    EXECUTE format(
+                        'ALTER TABLE student_score_history ATTACH PARTITION %I '
+                        'FOR VALUES FROM (%L) TO (%L)',
+                        partition_name,
+                        month_start,
+                        (month_start + interval '1 month')::date
+                    );
+                ELSE
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF student_score_history '
+                        'FOR VALUES FROM (%L) TO (%L)',
+                        partition_name,
+                        month_start,
+                        (month_start + interval '1 month')::date
+                    );
+                END IF;
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("SELECT create_score_history_partitions(3)")
+
+
+def downgrade() -> None:
+    op.execute("""
+        CREATE OR REPLACE FUNCTION create_score_history_partitions(months integer) RETURNS void AS $$
+        DECLARE
+            month_start date;
+        BEGIN
+            FOR i IN 0..months LOOP
+                month_start := (date_trunc('month', now()) + make_interval(months => i))::date;
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF student_score_history '
+                    'FOR VALUES FROM (%L) TO (%L)',
+                    'student_score_history_' || to_char(month_start, 'YYYY_MM'),
+                    month_start,
+                    (month_start + interval '1 month')::date
+                );
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+    """)
@@ -1,7 +1,21 @@
 from datetime import datetime
 from typing import List
 
-from sqlalchemy import BigInteger, String, Integer, ForeignKey, UniqueConstraint, func
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    Column,
+    DateTime,
+    Double,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+    func,
+)
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from database.base import Base
@@ -34,8 +48,8 @@ class StudentScore(Base):
     score: Mapped[int] = mapped_column(Integer, nullable=False)
     student_id: Mapped[int] = mapped_column(ForeignKey("student.id"), nullable=False)
     subject_id: Mapped[int] = mapped_column(ForeignKey("subject.id"), nullable=False)
-    student: Mapped["Student"] = relationship("Student", back_populates="scores", lazy="joined")
-    subject: Mapped["Subject"] = relationship("Subject", back_populates="scores", lazy="joined")
+    student: Mapped["Student"] = relationship("Student", back_populates="scores")
+    subject: Mapped["Subject"] = relationship("Subject", back_populates="scores")
 
     __table_args__ = (
         UniqueConstraint(
@@ -43,5 +57,36 @@ class StudentScore(Base):
             "subject_id",
             name="_student_subject_uc"
         ),
+        Index(
+            "ix_student_score_student_id",
+            "student_id",
+            postgresql_include=["subject_id", "score"]
+        ),
     )
 
+
+# Материализованное представление со статистикой баллов по предметам.
+# Отдельные метаданные, чтобы autogenerate Alembic не считал его таблицей
+views_metadata = MetaData()
+
+subject_score_stats = Table(
+    "subject_score_stats",
+    views_metadata,
+    Column("subject_id", Integer, primary_key=True),
+    Column("students", Integer, nullable=False),
+    Column("average", Double),
+    Column("score_counts", ARRAY(Integer), nullable=False),
+)
+
+# Секционированная по месяцам история баллов. Таблицу, секции и триггеры
+# создают миграции вручную, поэтому она тоже вне метаданных autogenerate
+partitioned_metadata = MetaData()
+
+student_score_history = Table(
+    "student_score_history",
+    partitioned_metadata,
+    Column("student_id", Integer, nullable=False),
+    Column("subject_id", Integer, nullable=False),
+    Column("score", Integer, nullable=False),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import re
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from config.config import BASE_DIR, Config
+
+logger = logging.getLogger("bot")
+
+VERSIONS_DIR = Path(__file__).resolve().parent / "migrations" / "versions"
+ALEMBIC_INI = BASE_DIR / "config" / "alembic.ini"
+
+CURRENT_REVISIONS = text("SELECT version_num FROM alembic_version")
+
+_REVISION = re.compile(r"^revision\b[^=]*=\s*['\"](\w+)['\"]", re.M)
+_DOWN_REVISION = re.compile(r"^down_revision\b[^=]*=(.*)$", re.M)
+_REVISION_ID = re.compile(r"['\"](\w+)['\"]")
+
+
+def read_revisions(versions_dir: Path = VERSIONS_DIR) -> tuple[set[str], set[str]]:
+    """Все ревизии миграций и последние из них, без импорта Alembic.
+
+    Идентификаторы берутся из строк ``revision = ...`` и
+    ``down_revision = ...`` файлов миграций.
+    """
+    revisions = set()
+    parents = set()
+    for path in versions_dir.glob("*.py"):
+        source = path.read_text(encoding="utf-8")
+        revision = _REVISION.search(source)
+        if revision is None:
+            continue
+        revisions.add(revision.group(1))
+        down_revision = _DOWN_REVISION.search(source)
+        if down_revision is not None:
+            parents.update(_REVISION_ID.findall(down_revision.group(1)))
+    return revisions, revisions - parents
+
+
+async def current_revisions(config: Config) -> set[str]:
+    """Ревизии из alembic_version, пустое множество для пустой БД."""
+    engine = create_async_engine(
+        config.db.create_url_db(),
+        poolclass=NullPool,
+        connect_args=config.db.create_engine_options()["connect_args"]
+    )
+    try:
+        async with engine.connect() as connection:
+            result = await connection.execute(CURRENT_REVISIONS)
+            return set(result.scalars())
+    except ProgrammingError:
+        # Таблицы alembic_version еще нет
+        return set()
+    finally:
+        await engine.dispose()
+
+
+async def upgrade_schema() -> None:
+    """Запускает ``alembic upgrade head`` в отдельном процессе.
+
+    env.py миграций настраивает логирование и запускает свой цикл
+    событий, поэтому Alembic не импортируется в процесс бота.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "alembic", "-c", str(ALEMBIC_INI), "upgrade", "head",
+        cwd=BASE_DIR
+    )
+    if await process.wait():
+        raise RuntimeError("alembic upgrade head exited with %s" % process.returncode)
+
+
+async def ensure_schema(config: Config) -> bool:
+    """Применяет миграции, только если схема БД отстает от кода.
+
+    Возвращает True, если запускался Alembic.
+    """
+    revisions, heads = read_revisions()
+    current = await current_revisions(config)
+    if current == heads:
+        return False
+    if not current <= revisions:
+        # Схему уже обновила более новая версия бота
+        logger.warning("Неизвестная ревизия схемы БД %s, миграции пропущены", current)
+        return False
+    logger.info("Схема БД %s отстает от %s, применяются миграции", current or "пустая", heads)
+    await upgrade_schema()
+    return True
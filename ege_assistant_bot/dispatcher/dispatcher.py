@@ -1,72 +1,318 @@
+import asyncio
 from datetime import timedelta
 
-from aiogram import Dispatcher, F
+from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.state import default_state
-from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.fsm.storage.base import BaseStorage
 from redis.asyncio import Redis
 
+from common.jobs import PeriodicJob
+from common.speedups import json_codec
 from config.config import Config
-from config.config import config as c
-from database.db import create_pool
+from database.db import SessionRouter, create_pool, warm_up_pool
 from handlers import handlers
-from middlewares.middlewares import DBSessionMiddleware
+from metrics.metrics import (
+    REGISTRY,
+    FunctionGauge,
+    MetricsServer,
+    TelegramTimingMiddleware,
+    instrument_engine,
+)
+from middlewares.middlewares import (
+    DBSessionMiddleware,
+    FSMFlushMiddleware,
+    HandlerMetricsMiddleware,
+    MetricsMiddleware,
+    ThrottlingMiddleware,
+)
+from routing.routing import IndexedMessageObserver, TextIs
+from services.broadcast import RESERVATION_REFRESH, reserved_rate
+from services.history import HistoryPartitionKeeper
+from services.score_views import ScoreViewCache
+from services.scores import ScoreWriter, is_valid_score
+from services.sender import MessageSender
+from services.stats import StatsRefresher
+from services.students import StudentIdentityCache
+from services.subjects import SubjectCatalog
+from services.throttling import RateLimiter
+from storage.storage import CachedStorage, PipelinedRedisStorage, TimedStorage
 from state.states import UserRegisterData, ScoreData
 
+# Хендлеры с этим флагом не обращаются к БД и не получают сессию
+NO_DB_SESSION = {"db_session": False}
+# Хендлеры с этим флагом только читают и могут получить сессию реплики
+READ_ONLY = {"db_replica": True}
+# Меньше этого бот не отправляет, даже если лимит заняли рассылки, сообщ/с
+MIN_SENDER_RATE = 1.0
 
-subjects = c.subjects.names.split(",")
 
-
-async def _get_storage(config: Config):
+async def _get_storage(config: Config) -> BaseStorage:
     default_ttl = timedelta(days=1)
     redis = Redis.from_url(config.redis.url_db)
-    storage = RedisStorage(
+    json_loads, json_dumps = json_codec(config.speedups.json)
+    storage = PipelinedRedisStorage(
         redis=redis,
         state_ttl=default_ttl,
-        data_ttl=default_ttl
+        data_ttl=default_ttl,
+        json_loads=json_loads,
+        json_dumps=json_dumps
     )
+    if config.redis.fsm_cache_size > 0:
+        storage = CachedStorage(storage=storage, max_size=config.redis.fsm_cache_size)
+    if config.metrics.enabled:
+        storage = TimedStorage(storage=storage)
     return storage
 
 
-def _setup_outer_middlewares(dispatcher: Dispatcher, config: Config) -> None:
-    pool = dispatcher["session_pool"] = create_pool(config.db.create_url_db())
+def _setup_metrics(dispatcher: Dispatcher, config: Config) -> None:
+    dispatcher.update.outer_middleware(MetricsMiddleware())
+    dispatcher.message.middleware(HandlerMetricsMiddleware())
+    for engine in dispatcher["session_router"].engines:
+        instrument_engine(engine)
+
+    storage = dispatcher.storage
+    if config.redis.fsm_cache_size > 0:
+        REGISTRY.append(FunctionGauge(
+            name="bot_fsm_cache_hit_rate",
+            documentation="FSM cache hit rate",
+            function=lambda: storage.hit_rate
+        ))
+
+    server = MetricsServer(host=config.metrics.host, port=config.metrics.port)
+
+    async def on_startup(bot: Bot) -> None:
+        bot.session.middleware(TelegramTimingMiddleware())
+        await server.start()
+
+    dispatcher.startup.register(on_startup)
+    dispatcher.shutdown.register(server.stop)
+
+
+def _setup_database(dispatcher: Dispatcher, config: Config) -> None:
+    pool = dispatcher["session_pool"] = create_pool(
+        config.db.create_url_db(),
+        **config.db.create_engine_options()
+    )
+    replicas = [
+        create_pool(config.db.create_url_db(host), **config.db.create_engine_options())
+        for host in config.db.replica_hosts
+    ]
+    router = dispatcher["session_router"] = SessionRouter(
+        primary=pool,
+        replicas=replicas,
+        max_lag=config.db.replica_max_lag,
+        check_interval=config.db.replica_check_interval,
+        read_your_writes=config.db.read_your_writes
+    )
+    score_writer = dispatcher["score_writer"] = None
+    if config.score_buffer.enabled:
+        score_writer = dispatcher["score_writer"] = ScoreWriter(
+            session_pool=pool,
+            max_rows=config.score_buffer.max_rows,
+            max_delay=config.score_buffer.max_delay
+        )
+
+    async def on_startup() -> None:
+        await asyncio.gather(*(
+            warm_up_pool(engine, config.db.pool_warmup) for engine in router.engines
+        ))
+        await router.start()
+
+    async def on_shutdown() -> None:
+        await router.stop()
+        # Накопленные баллы пишутся до закрытия пула
+        if score_writer is not None:
+            await score_writer.close()
+        await asyncio.gather(*(engine.dispose() for engine in router.engines))
+
+    dispatcher.startup.register(on_startup)
+    dispatcher.shutdown.register(on_shutdown)
+
+
+def _setup_middlewares(dispatcher: Dispatcher, config: Config) -> None:
+    if config.metrics.enabled:
+        _setup_metrics(dispatcher=dispatcher, config=config)
+
+    # Внутренний middleware: флаги хендлера доступны только после фильтров
+    dispatcher.message.middleware(DBSessionMiddleware(router=dispatcher["session_router"]))
+
+    if config.redis.fsm_cache_size > 0:
+        dispatcher.update.outer_middleware(FSMFlushMiddleware(dispatcher.storage))
+
+
+def _setup_caches(dispatcher: Dispatcher, config: Config) -> None:
+    # Отдельный от FSM клиент: хранилище FSM закрывается на shutdown
+    # раньше, чем успевают остановиться подписки кэшей
+    redis = dispatcher["redis"] = Redis.from_url(config.redis.url_db)
+    catalog = dispatcher["subject_catalog"] = SubjectCatalog(
+        session_pool=dispatcher["session_pool"],
+        ttl=config.subjects.cache_ttl
+    )
+    student_cache = dispatcher["student_cache"] = StudentIdentityCache(
+        redis=redis,
+        ttl=config.student_cache.ttl,
+        max_size=config.student_cache.max_size,
+        channel=config.student_cache.invalidate_channel
+    )
+    dispatcher["score_views"] = ScoreViewCache(
+        redis=redis,
+        ttl=config.score_views.ttl,
+        max_size=config.score_views.max_size,
+        fill_delay=config.db.replica_delay()
+    )
+    stats_refresher = StatsRefresher(
+        session_pool=dispatcher["session_pool"],
+        redis=redis,
+        interval=config.stats.refresh_interval
+    )
+    partition_keeper = HistoryPartitionKeeper(
+        session_pool=dispatcher["session_pool"],
+        redis=redis,
+        months_ahead=config.history.months_ahead,
+        interval=config.history.partition_interval
+    )
+
+    async def on_startup() -> None:
+        await catalog.start(
+            redis=redis,
+            channel=config.subjects.invalidate_channel
+        )
+        await student_cache.start()
+        await stats_refresher.start()
+        await partition_keeper.start()
+
+    async def on_shutdown() -> None:
+        await catalog.stop()
+        await student_cache.stop()
+        await stats_refresher.stop()
+        await partition_keeper.stop()
+        await redis.aclose()
 
-    dispatcher.update.outer_middleware(DBSessionMiddleware(session_pool=pool))
+    dispatcher.startup.register(on_startup)
+    dispatcher.shutdown.register(on_shutdown)
 
 
-def _register_handlers(dispatcher: Dispatcher):
+def _sender_rate(config: Config, reserved: float) -> float:
+    # Лимит Telegram общий для бота, поэтому делится между процессами,
+    # а часть его забирают идущие рассылки. Совсем отвечать бот не
+    # перестает: минимум MIN_SENDER_RATE на все процессы
+    return max(config.sender.rate - reserved, MIN_SENDER_RATE) / config.workers.count
+
+
+def _setup_sender(dispatcher: Dispatcher, config: Config) -> None:
+    redis = dispatcher["redis"]
+    sender = dispatcher["sender"] = MessageSender(
+        rate=_sender_rate(config, reserved=0.0),
+        chat_interval=config.sender.chat_interval,
+        max_pending=config.sender.max_pending,
+        max_in_flight=config.sender.max_in_flight,
+        max_retries=config.sender.max_retries,
+        shutdown_timeout=config.sender.shutdown_timeout
+    )
+
+    async def follow_broadcasts() -> None:
+        sender.set_rate(_sender_rate(config, await reserved_rate(redis)))
+
+    watcher = PeriodicJob(
+        follow_broadcasts,
+        interval=RESERVATION_REFRESH,
+        error_message="Не удалось прочитать скорость рассылок"
+    )
+
+    async def on_startup(bot: Bot) -> None:
+        await sender.start(bot)
+        watcher.start()
+
+    async def on_shutdown() -> None:
+        await watcher.stop()
+        await sender.stop()
+
+    dispatcher.startup.register(on_startup)
+    dispatcher.shutdown.register(on_shutdown)
+
+    if config.metrics.enabled:
+        REGISTRY.append(FunctionGauge(
+            name="bot_outbox_pending",
+            documentation="Messages waiting in the outgoing queue",
+            function=lambda: sender.pending
+        ))
+        REGISTRY.append(FunctionGauge(
+            name="bot_outbox_retried",
+            documentation="Outgoing messages scheduled for retry",
+            function=lambda: sender.retried
+        ))
+        REGISTRY.append(FunctionGauge(
+            name="bot_outbox_failed",
+            documentation="Outgoing messages dropped after errors",
+            function=lambda: sender.failed
+        ))
+
+
+def _setup_throttling(dispatcher: Dispatcher, config: Config) -> None:
+    limiter = RateLimiter(
+        redis=dispatcher["redis"],
+        max_delay=config.throttling.max_delay,
+        max_size=config.throttling.local_cache_size
+    )
+    middleware = ThrottlingMiddleware(limiter=limiter, config=config.throttling)
+    dispatcher.message.outer_middleware(middleware)
+
+    if config.metrics.enabled:
+        REGISTRY.append(FunctionGauge(
+            name="bot_throttled_updates_dropped",
+            documentation="Updates dropped by the rate limiter",
+            function=lambda: middleware.dropped
+        ))
+        REGISTRY.append(FunctionGauge(
+            name="bot_throttled_updates_delayed",
+            documentation="Updates delayed by the rate limiter",
+            function=lambda: middleware.delayed
+        ))
+
+
+def _register_handlers(dispatcher: Dispatcher, config: Config):
+    subjects = config.subjects.names.split(",")
+
     dispatcher.message.register(
         handlers.process_start_command,
         CommandStart(),
-        StateFilter(default_state)
+        StateFilter(default_state),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_login,
-        F.text == "/login"
+        TextIs("/login"),
+        flags=READ_ONLY
     )
     dispatcher.message.register(
         handlers.process_register,
         StateFilter(default_state),
-        F.text == "/register"
+        TextIs("/register"),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_cancel_register,
         ~StateFilter(default_state),
-        F.text == "/cancel_register"
+        TextIs("/cancel_register"),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_cancel,
         ~StateFilter(default_state),
-        F.text == "/cancel"
+        TextIs("/cancel"),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_first_name_sent,
         StateFilter(UserRegisterData.first_name),
-        F.text.isalpha()
+        F.text.isalpha(),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.warning_not_first_name,
-        StateFilter(UserRegisterData.first_name)
+        StateFilter(UserRegisterData.first_name),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_last_name_sent,
@@ -75,38 +321,72 @@ def _register_handlers(dispatcher: Dispatcher):
     )
     dispatcher.message.register(
         handlers.warning_not_last_name,
-        StateFilter(UserRegisterData.last_name)
+        StateFilter(UserRegisterData.last_name),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_enter_scores,
-        F.text == "/enter_scores"
+        TextIs("/enter_scores"),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_subject_sent,
         StateFilter(ScoreData.subject),
-        F.text.in_(subjects)
+        TextIs(*subjects),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.warning_not_subject,
-        StateFilter(ScoreData.subject)
+        StateFilter(ScoreData.subject),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_score_sent,
         StateFilter(ScoreData.score),
-        lambda x: x.text.isdigit() and 0 < int(x.text) < 100
+        lambda x: x.text.isdigit() and is_valid_score(int(x.text))
     )
     dispatcher.message.register(
         handlers.warning_not_score,
-        StateFilter(ScoreData.score)
+        StateFilter(ScoreData.score),
+        flags=NO_DB_SESSION
     )
     dispatcher.message.register(
         handlers.process_view_scores,
-        F.text == "/view_scores"
+        TextIs("/view_scores"),
+        flags=READ_ONLY
+    )
+    dispatcher.message.register(
+        handlers.process_stats,
+        TextIs("/stats"),
+        flags=READ_ONLY
     )
+    dispatcher.message.register(
+        handlers.process_history,
+        TextIs("/history"),
+        flags=READ_ONLY
+    )
+
+
+def resolve_update_types(config: Config) -> list[str]:
+    dispatcher = Dispatcher(disable_fsm=True)
+    IndexedMessageObserver.install(dispatcher)
+    _register_handlers(dispatcher=dispatcher, config=config)
+    return dispatcher.resolve_used_update_types()
 
 
-async def create_dispatcher(config: Config) -> Dispatcher:
-    dispatcher: Dispatcher = Dispatcher(storage=await _get_storage(config))
-    _register_handlers(dispatcher=dispatcher)
-    _setup_outer_middlewares(dispatcher=dispatcher, config=config)
+async def create_dispatcher(
+        config: Config,
+        storage: BaseStorage | None = None
+) -> Dispatcher:
+    storage = storage or await _get_storage(config)
+    dispatcher: Dispatcher = Dispatcher(storage=storage)
+    # Команды и состояния ищутся по словарю, а не перебором фильтров
+    IndexedMessageObserver.install(dispatcher)
+    _register_handlers(dispatcher=dispatcher, config=config)
+    _setup_database(dispatcher=dispatcher, config=config)
+    _setup_middlewares(dispatcher=dispatcher, config=config)
+    _setup_caches(dispatcher=dispatcher, config=config)
+    _setup_sender(dispatcher=dispatcher, config=config)
+    if config.throttling.enabled:
+        _setup_throttling(dispatcher=dispatcher, config=config)
     return dispatcher
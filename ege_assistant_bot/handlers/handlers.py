@@ -2,55 +2,127 @@ import logging
 
 from aiogram import Router
 from aiogram.fsm.context import FSMContext
-from aiogram.types import (
-    Message,
-    ReplyKeyboardMarkup,
-    KeyboardButton
-)
-from sqlalchemy import select
+from aiogram.types import Message
+from sqlalchemy import Integer, bindparam, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from state.states import UserRegisterData, ScoreData
-from database.models import Student, StudentScore, Subject
+from database.models import Student, StudentScore, Subject, subject_score_stats
+from services.history import (
+    HISTORY_LIMIT, MESSAGE_LIMIT, STUDENT_HISTORY, format_trend, group_scores
+)
+from services.score_views import ScoreViewCache
+from services.scores import ScoreWriter
+from services.sender import MessageSender
+from services.stats import score_percentile
+from services.students import StudentIdentity, StudentIdentityCache
+from services.subjects import SubjectCatalog
+from storage.storage import FSMBatch
 
 
 router = Router()
 logger = logging.getLogger("bot")
-logger.setLevel(logging.DEBUG)
 
 
-def create_subjects_keyboard(subjects):
-    return [[KeyboardButton(text=f"{subject.name}")] for subject in subjects]
+# Запросы собираются один раз при импорте и выполняются с параметрами:
+# SQLAlchemy не строит выражение заново и берет SQL из кэша компиляции
+_upsert_score = insert(StudentScore.__table__).from_select(
+    ["student_id", "subject_id", "score"],
+    select(
+        Student.id,
+        Subject.id,
+        bindparam("score", type_=Integer)
+    ).where(
+        Student.telegram_id == bindparam("telegram_id"),
+        Subject.name == bindparam("subject_name")
+    )
+)
+UPSERT_STUDENT_SCORE = _upsert_score.on_conflict_do_update(
+    constraint="_student_subject_uc",
+    set_={"score": _upsert_score.excluded.score}
+)
 
+_insert_score = insert(StudentScore).values(
+    student_id=bindparam("student_id"),
+    subject_id=bindparam("subject_id"),
+    score=bindparam("score")
+)
+INSERT_STUDENT_SCORE = _insert_score.on_conflict_do_update(
+    constraint="_student_subject_uc",
+    set_={"score": _insert_score.excluded.score}
+)
 
-async def get_subjects(session: AsyncSession):
-    stmt = select(Subject)
-    result = await session.scalars(stmt)
-    return result.all()
+STUDENT_SCORES = select(
+    Subject.name,
+    StudentScore.score
+).join(
+    StudentScore, StudentScore.subject_id == Subject.id
+).join(
+    Student, Student.id == StudentScore.student_id
+).where(
+    Student.telegram_id == bindparam("telegram_id")
+).order_by(Subject.name)
+
+STUDENT_STATS = select(
+    Subject.name,
+    StudentScore.score,
+    subject_score_stats.c.students,
+    subject_score_stats.c.average,
+    subject_score_stats.c.score_counts
+).join(
+    StudentScore, StudentScore.subject_id == Subject.id
+).join(
+    Student, Student.id == StudentScore.student_id
+).outerjoin(
+    subject_score_stats, subject_score_stats.c.subject_id == Subject.id
+).where(
+    Student.telegram_id == bindparam("telegram_id")
+).order_by(Subject.name)
+
+
+async def upsert_student_score(
+        telegram_id: int,
+        subject_name: str,
+        score: int,
+        session: AsyncSession
+) -> bool:
+    result = await session.execute(
+        UPSERT_STUDENT_SCORE,
+        {"telegram_id": telegram_id, "subject_name": subject_name, "score": score}
+    )
+    await session.commit()
+    return result.rowcount > 0
 
 
-async def get_user_by_telegram_id(telegram_id: int, session: AsyncSession):
-    stmt = select(Student).where(Student.telegram_id == telegram_id)
-    result = await session.scalar(stmt)
-    return result
+async def save_student_score(
+        student_id: int,
+        subject_id: int,
+        score: int,
+        session: AsyncSession
+) -> None:
+    await session.execute(
+        INSERT_STUDENT_SCORE,
+        {"student_id": student_id, "subject_id": subject_id, "score": score}
+    )
+    await session.commit()
 
 
-async def get_subject_by_name(name: str, session: AsyncSession):
-    stmt = select(Subject).where(Subject.name == name)
-    result = await session.scalar(stmt)
-    return result
+async def get_student_scores(telegram_id: int, session: AsyncSession):
+    result = await session.execute(STUDENT_SCORES, {"telegram_id": telegram_id})
+    return result.all()
 
 
-async def check_number_in_db_command(telegram_id: int, session: AsyncSession):
-    stmt = select(Student).where(Student.telegram_id == telegram_id)
-    res = await session.execute(stmt)
-    return res.one_or_none()
+async def get_student_stats(telegram_id: int, session: AsyncSession):
+    result = await session.execute(STUDENT_STATS, {"telegram_id": telegram_id})
+    return result.all()
 
 
-async def process_start_command(message: Message, state: FSMContext):
-    logger.info("Пользователь %s начал взаимодействие с ботом" % message.chat.id)
+async def process_start_command(message: Message, state: FSMContext, sender: MessageSender):
+    logger.info("Пользователь %s начал взаимодействие с ботом", message.chat.id)
     await state.clear()
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="Привет!\nЧтобы пользоваться ботом нужно войти в аккаунт /login "
              "или зарегистрироваться /register",
 
@@ -60,46 +132,51 @@ async def process_start_command(message: Message, state: FSMContext):
 async def process_login(
         message: Message,
         state: FSMContext,
-        session: AsyncSession
+        session: AsyncSession,
+        student_cache: StudentIdentityCache,
+        sender: MessageSender
 ):
-    logger.info("Пользователь %s дал доступ к своему профилю" % message.chat.id)
-    user = await check_number_in_db_command(
+    logger.info("Пользователь %s дал доступ к своему профилю", message.chat.id)
+    user = await student_cache.resolve(
         telegram_id=message.chat.id,
         session=session
     )
 
     if not user:
-        logger.info("Пользователь %s не найден в БД" % message.chat.id)
+        logger.info("Пользователь %s не найден в БД", message.chat.id)
         await state.update_data(
             telegram_id=message.chat.id
         )
-        await message.answer(
+        await sender.send(
+            message.chat.id,
             text="Твои данные не найдены. Нужно зарегистрироваться /register"
         )
         return
 
     await state.update_data(login=True)
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="Успешная авторизация"
     )
     logger.info(
-        "Пользователь %s успешно авторизовался" % message.chat.id
+        "Пользователь %s успешно авторизовался", message.chat.id
     )
 
 
-async def process_register(message: Message, state: FSMContext):
+async def process_register(message: Message, state: FSMContext, sender: MessageSender):
     logger.info(
-        "Пользователь %s начал регистрацию" % message.chat.id
+        "Пользователь %s начал регистрацию", message.chat.id
     )
-    await message.answer(text="Введи свое имя")
+    await sender.send(message.chat.id, text="Введи свое имя")
     await state.set_state(UserRegisterData.first_name)
 
 
-async def process_cancel_register(message: Message, state: FSMContext):
+async def process_cancel_register(message: Message, state: FSMContext, sender: MessageSender):
     logger.info(
-        "Пользователь %s отменил регистрации" % message.chat.id
+        "Пользователь %s отменил регистрации", message.chat.id
     )
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="Ты отменил регистрацию\n\n"
              "Чтобы снова перейти к заполнению анкеты - "
              "нажми кнопку /register"
@@ -107,28 +184,31 @@ async def process_cancel_register(message: Message, state: FSMContext):
     await state.clear()
 
 
-async def process_cancel(message: Message, state: FSMContext):
-    await message.answer(
+async def process_cancel(message: Message, state: FSMContext, sender: MessageSender):
+    await sender.send(
+        message.chat.id,
         text="Действие отменено"
     )
-    await state.clear()
-    await state.update_data(login=True)
+    async with FSMBatch(state) as batch:
+        batch.clear()
+        batch.update_data(login=True)
 
 
-async def process_first_name_sent(message: Message, state: FSMContext):
+async def process_first_name_sent(message: Message, state: FSMContext, sender: MessageSender):
     logger.info(
-        "Пользователь %s ввел имя %s для регистрации" % (message.chat.id, message.text)
+        "Пользователь %s ввел имя %s для регистрации", message.chat.id, message.text
     )
     await state.update_data(first_name=message.text)
-    await message.answer(text="Спасибо!\n\nА теперь введи свою фамилию")
+    await sender.send(message.chat.id, text="Спасибо!\n\nА теперь введи свою фамилию")
     await state.set_state(UserRegisterData.last_name)
 
 
-async def warning_not_first_name(message: Message):
+async def warning_not_first_name(message: Message, sender: MessageSender):
     logger.info(
-        "Пользователь %s ввел некорректное имя %s при регистрации" % (message.chat.id, message.text)
+        "Пользователь %s ввел некорректное имя %s при регистрации", message.chat.id, message.text
     )
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="То, что ты отправил не похоже на имя\n\n"
              "Пожалуйста, введи свое имя\n\n"
              "Если ты хочешь прервать заполнение анкеты - "
@@ -136,38 +216,52 @@ async def warning_not_first_name(message: Message):
     )
 
 
-async def process_last_name_sent(message: Message, state: FSMContext, session: AsyncSession):
+async def process_last_name_sent(
+        message: Message,
+        state: FSMContext,
+        session: AsyncSession,
+        student_cache: StudentIdentityCache,
+        sender: MessageSender
+):
     logger.info(
-        "Пользователь %s ввел фамилию %s для регистрации" % (message.chat.id, message.text)
+        "Пользователь %s ввел фамилию %s для регистрации", message.chat.id, message.text
     )
-    await state.update_data(last_name=message.text)
     data = await state.get_data()
-    first_name = data.get("first_name")
-    last_name = data.get("last_name")
     instance = Student(
-        first_name=first_name,
-        last_name=last_name,
+        first_name=data.get("first_name"),
+        last_name=message.text,
         telegram_id=message.chat.id
     )
     session.add(instance)
     await session.commit()
-    await state.clear()
-    await state.update_data(login=True)
-    await message.answer(
+    await student_cache.set(
+        message.chat.id,
+        StudentIdentity(
+            id=instance.id,
+            first_name=instance.first_name,
+            last_name=instance.last_name
+        )
+    )
+    async with FSMBatch(state) as batch:
+        batch.clear()
+        batch.update_data(login=True)
+    await sender.send(
+        message.chat.id,
         text="Спасибо!\n\n"
              "Регистрация пройдена.\n\n"
              "Можешь сохранить или посмотреть сохраненные баллы"
     )
     logger.info(
-        "Пользователь %s успешно зарегистрировался" % message.chat.id
+        "Пользователь %s успешно зарегистрировался", message.chat.id
     )
 
 
-async def warning_not_last_name(message: Message):
+async def warning_not_last_name(message: Message, sender: MessageSender):
     logger.info(
-        "Пользователь %s ввел некорректною фамилию %s для регистрации" % (message.chat.id, message.text)
+        "Пользователь %s ввел некорректною фамилию %s для регистрации", message.chat.id, message.text
     )
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="То, что ты отправил не похоже на фамилию\n\n"
              "Пожалуйста, введи свою фамилию\n\n"
              "Если ты хочешь прервать заполнение анкеты - "
@@ -175,40 +269,43 @@ async def warning_not_last_name(message: Message):
     )
 
 
-async def process_enter_scores(message: Message, state: FSMContext, session: AsyncSession):
+async def process_enter_scores(
+        message: Message,
+        state: FSMContext,
+        subject_catalog: SubjectCatalog,
+        sender: MessageSender
+):
     login = await state.get_data()
     if not login.get("login"):
-        await message.answer(
+        await sender.send(
+            message.chat.id,
             text="Чтобы сохранить результат экзамена, нужно войти в аккаунт /login"
         )
         logger.info(
-            "Пользователь %s пытался сохранить баллы без авторизации" % message.chat.id
+            "Пользователь %s пытался сохранить баллы без авторизации", message.chat.id
         )
         return
     logger.info(
-        "Пользователь %s начал процесс сохранения баллов" % message.chat.id
+        "Пользователь %s начал процесс сохранения баллов", message.chat.id
     )
-    subjects = await get_subjects(session)
-    keyboard = create_subjects_keyboard(subjects)
+    keyboard = await subject_catalog.get_keyboard()
     await state.set_state(ScoreData.subject)
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="Выбери предмет, для которого нужно сохранить баллы\n"
              "Если ты хочешь прервать сохранение баллов - "
              "нажми кнопку /cancel",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        reply_markup=keyboard
     )
 
 
-async def process_subject_sent(message: Message, state: FSMContext):
+async def process_subject_sent(message: Message, state: FSMContext, sender: MessageSender):
     logger.info(
-        "Пользователь %s выбрал предмет %s для сохранения баллов" % (message.chat.id, message.text)
+        "Пользователь %s выбрал предмет %s для сохранения баллов", message.chat.id, message.text
     )
     await state.update_data(subject=message.text)
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         text="Теперь введите сумму баллов\n"
              "Если ты хочешь прервать сохранение баллов - "
              "нажми кнопку /cancel"
@@ -216,59 +313,197 @@ async def process_subject_sent(message: Message, state: FSMContext):
     await state.set_state(ScoreData.score)
 
 
-async def warning_not_subject(message: Message):
+async def warning_not_subject(message: Message, sender: MessageSender):
     logger.info(
-        "Пользователь %s ввел некорректный предмет %s" % (message.chat.id, message.text)
+        "Пользователь %s ввел некорректный предмет %s", message.chat.id, message.text
     )
-    await message.answer(text="Доступны только предметы из списка")
+    await sender.send(message.chat.id, text="Доступны только предметы из списка")
 
 
-async def process_score_sent(message: Message, state: FSMContext, session: AsyncSession):
+async def process_score_sent(
+        message: Message,
+        state: FSMContext,
+        session: AsyncSession,
+        subject_catalog: SubjectCatalog,
+        student_cache: StudentIdentityCache,
+        score_views: ScoreViewCache,
+        sender: MessageSender,
+        score_writer: ScoreWriter | None
+):
     logger.info(
-        "Пользователь %s ввел количество баллов %s" % (message.chat.id, message.text)
+        "Пользователь %s ввел количество баллов %s", message.chat.id, message.text
     )
-    await state.update_data(score=message.text)
     data = await state.get_data()
-    subject = data.get("subject")
-    score = int(data.get("score"))
-    student = await get_user_by_telegram_id(message.chat.id, session)
-    subject = await get_subject_by_name(subject, session)
-    instance = StudentScore(
-        student_id=student.id,
-        subject_id=subject.id,
-        score=score
-    )
-    session.add(instance)
-    await session.commit()
+    subject_id = await subject_catalog.get_id(data.get("subject"))
+    if subject_id is None:
+        # Предмета из конфигурации нет в БД (переименован или удален):
+        # студент остается в аккаунте и выбирает предмет заново
+        logger.info(
+            "Пользователь %s сохранял баллы по неизвестному предмету %s",
+            message.chat.id, data.get("subject")
+        )
+        keyboard = await subject_catalog.get_keyboard()
+        await state.set_state(ScoreData.subject)
+        await sender.send(
+            message.chat.id,
+            text=f"Предмет {data.get('subject')} сейчас недоступен. Выбери другой предмет\n"
+                 "Если ты хочешь прервать сохранение баллов - "
+                 "нажми кнопку /cancel",
+            reply_markup=keyboard
+        )
+        return
+    student = await student_cache.get(message.chat.id)
+    if student is not None:
+        if score_writer is not None:
+            # Возвращается после commit пачки, в которую попал балл
+            await score_writer.save(
+                student_id=student.id,
+                subject_id=subject_id,
+                score=int(message.text)
+            )
+        else:
+            await save_student_score(
+                student_id=student.id,
+                subject_id=subject_id,
+                score=int(message.text),
+                session=session
+            )
+        saved = True
+    else:
+        saved = await upsert_student_score(
+            telegram_id=message.chat.id,
+            subject_name=data.get("subject"),
+            score=int(message.text),
+            session=session
+        )
+    if saved:
+        # Баллы уже в БД: ответ /view_scores, собранный раньше, устарел
+        await score_views.invalidate(message.chat.id)
+    async with FSMBatch(state) as batch:
+        batch.clear()
+        if saved:
+            batch.update_data(login=True)
+    if not saved:
+        logger.info(
+            "Пользователь %s не найден в БД при сохранении баллов", message.chat.id
+        )
+        await sender.send(
+            message.chat.id,
+            text="Твои данные не найдены. Нужно зарегистрироваться /register"
+        )
+        return
     logger.info(
-        "Пользователь %s успешно сохранил баллы" % message.chat.id
+        "Пользователь %s успешно сохранил баллы", message.chat.id
     )
-    await message.answer(text="Баллы сохранены")
-    await state.clear()
-    await state.update_data(login=True)
+    await sender.send(message.chat.id, text="Баллы сохранены")
 
 
-async def warning_not_score(message: Message):
+async def warning_not_score(message: Message, sender: MessageSender):
     logger.info(
-        "Пользователь %s ввел некорректную сумму баллов %s" % (message.chat.id, message.text)
+        "Пользователь %s ввел некорректную сумму баллов %s", message.chat.id, message.text
     )
-    await message.answer(text="Введи корректные данные")
+    await sender.send(message.chat.id, text="Введи корректные данные")
 
 
-async def process_view_scores(message: Message, state: FSMContext, session: AsyncSession):
+async def process_view_scores(
+        message: Message,
+        state: FSMContext,
+        session: AsyncSession,
+        score_views: ScoreViewCache,
+        sender: MessageSender
+):
     login = await state.get_data()
     if not login.get("login"):
-        await message.answer(
+        await sender.send(
+            message.chat.id,
             text="Чтобы посмотреть сохраненные результаты, нужно войти в аккаунт /login"
         )
         logger.info(
-            "Пользователь %s пытался посмотреть сохраненные баллы без авторизации" % message.chat.id
+            "Пользователь %s пытался посмотреть сохраненные баллы без авторизации", message.chat.id
         )
         return
-    stmt = select(StudentScore).join(Student, Student.telegram_id == message.chat.id)
-    result = await session.scalars(stmt)
-    result = [f"{res.subject.name}: {res.score}" for res in result]
-    if not result:
-        await message.answer(text="Пока ничего не сохранено")
+    version, text = await score_views.get(message.chat.id)
+    if text is None:
+        scores = await get_student_scores(message.chat.id, session)
+        text = "\n".join(f"{name}: {score}" for name, score in scores)
+        await score_views.set(message.chat.id, version, text)
+    if not text:
+        await sender.send(message.chat.id, text="Пока ничего не сохранено")
         return
-    await message.answer(text="\n".join(result))
+    await sender.send(message.chat.id, text=text)
+
+
+async def process_stats(
+        message: Message,
+        state: FSMContext,
+        session: AsyncSession,
+        sender: MessageSender
+):
+    login = await state.get_data()
+    if not login.get("login"):
+        await sender.send(
+            message.chat.id,
+            text="Чтобы посмотреть статистику, нужно войти в аккаунт /login"
+        )
+        logger.info(
+            "Пользователь %s пытался посмотреть статистику без авторизации", message.chat.id
+        )
+        return
+    stats = await get_student_stats(message.chat.id, session)
+    if not stats:
+        await sender.send(message.chat.id, text="Пока ничего не сохранено")
+        return
+    result = []
+    for name, score, students, average, score_counts in stats:
+        if not students:
+            result.append(f"{name}: {score} (статистика еще не готова)")
+            continue
+        percentile = score_percentile(score, score_counts)
+        result.append(
+            f"{name}: {score} (лучше, чем у {percentile:.0f}% участников, "
+            f"средний балл {average:.1f})"
+        )
+    await sender.send(message.chat.id, text="\n".join(result))
+
+
+async def process_history(
+        message: Message,
+        state: FSMContext,
+        session: AsyncSession,
+        student_cache: StudentIdentityCache,
+        sender: MessageSender
+):
+    login = await state.get_data()
+    if not login.get("login"):
+        await sender.send(
+            message.chat.id,
+            text="Чтобы посмотреть историю баллов, нужно войти в аккаунт /login"
+        )
+        logger.info(
+            "Пользователь %s пытался посмотреть историю баллов без авторизации", message.chat.id
+        )
+        return
+    student = await student_cache.resolve(telegram_id=message.chat.id, session=session)
+    if student is None:
+        await sender.send(
+            message.chat.id,
+            text="Твои данные не найдены. Нужно зарегистрироваться /register"
+        )
+        return
+    # Строки читаются курсором, готовые части ответа отправляются сразу
+    result = await session.stream(
+        STUDENT_HISTORY.execution_options(yield_per=HISTORY_LIMIT * 5),
+        {"student_id": student.id, "limit": HISTORY_LIMIT}
+    )
+    lines = []
+    sent = False
+    async for subject, scores in group_scores(result):
+        line = format_trend(subject, scores)
+        if lines and sum(map(len, lines)) + len(lines) + len(line) > MESSAGE_LIMIT:
+            await sender.send(message.chat.id, text="\n".join(lines))
+            lines, sent = [], True
+        lines.append(line)
+    if lines:
+        await sender.send(message.chat.id, text="\n".join(lines))
+    elif not sent:
+        await sender.send(message.chat.id, text="Пока ничего не сохранено")
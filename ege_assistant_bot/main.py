@@ -1,24 +1,62 @@
-import asyncio
-import logging
+import time
 
-from aiogram import Bot
+# Отсчет времени запуска начинается до импорта aiogram и SQLAlchemy
+STARTED = time.perf_counter()
 
-from commands.menu import menu
-from config.config import config
-from dispatcher.dispatcher import create_dispatcher
+import asyncio  # noqa: E402
+import logging  # noqa: E402
+
+from aiogram import Bot  # noqa: E402
+
+from commands.menu import menu  # noqa: E402
+from common.speedups import create_bot_session, run  # noqa: E402
+from common.startup import StartupTimer  # noqa: E402
+from config.config import get_config, setup_logging  # noqa: E402
+from database.schema import ensure_schema  # noqa: E402
+from dispatcher.dispatcher import create_dispatcher  # noqa: E402
 
 logger = logging.getLogger("bot")
 
 
 async def start():
-    bot = Bot(token=config.tg_bot.token)
-    dp = await create_dispatcher(config)
+    timer = StartupTimer(STARTED)
+    timer.mark("imports")
+    config = get_config()
+    setup_logging(config)
+    timer.mark("config")
+    logger.info("Start bot")
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await bot.set_my_commands(menu)
+    bot = Bot(token=config.tg_bot.token, session=create_bot_session(config.speedups))
+    # Оба шага ждут сети, поэтому выполняются одновременно
+    await asyncio.gather(ensure_schema(config), bot.set_my_commands(menu))
+    timer.mark("schema")
+
+    if config.workers.count > 1:
+        from workers.workers import run_sharded
+        timer.report()
+        await run_sharded(bot=bot, config=config)
+        return
+
+    dp = await create_dispatcher(config)
+    timer.mark("dispatcher")
+
+    async def on_ready() -> None:
+        # Регистрируется последним, поэтому выполняется после остальных
+        # startup-хендлеров: прогрева пула, загрузки кэшей
+        timer.mark("startup")
+        timer.report()
+
+    dp.startup.register(on_ready)
+    if config.webhook.enabled:
+        from webhook.webhook import run_webhook
+        await run_webhook(bot=bot, dispatcher=dp, config=config)
+        return
+    await bot.delete_webhook(
+        drop_pending_updates=config.tg_bot.drop_pending_updates
+    )
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    logger.info("Start bot")
-    asyncio.run(start())
+    # Цикл событий выбирается до запуска, поэтому конфиг читается здесь
+    run(start(), get_config().speedups)
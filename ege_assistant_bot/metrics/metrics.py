@@ -0,0 +1,248 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger("bot")
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# Этапы обработки апдейта, время которых копится в течение апдейта
+STAGES = ("throttle", "filters", "fsm", "db", "telegram")
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с произвольными метками."""
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...],
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: dict[tuple[str, ...], list[Any]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def _labels(self, key: tuple[str, ...], **extra: str) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        return ",".join('%s="%s"' % (name, value) for name, value in pairs)
+
+    def render(self) -> list[str]:
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s histogram" % self.name,
+        ]
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket{%s} %s" % (
+                    self.name, self._labels(key, le=repr(bound)), cumulative
+                ))
+            lines.append("%s_bucket{%s} %s" % (self.name, self._labels(key, le="+Inf"), count))
+            lines.append("%s_sum{%s} %s" % (self.name, self._labels(key), total))
+            lines.append("%s_count{%s} %s" % (self.name, self._labels(key), count))
+        return lines
+
+
+class FunctionGauge:
+    """Gauge, значение которого вычисляется в момент чтения метрик."""
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self) -> list[str]:
+        return [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s gauge" % self.name,
+            "%s %s" % (self.name, self.function()),
+        ]
+
+
+REGISTRY: list[Histogram | FunctionGauge] = []
+
+UPDATE_STAGE_SECONDS = Histogram(
+    name="bot_update_stage_seconds",
+    documentation="Time spent per update stage",
+    labelnames=("handler", "stage")
+)
+REGISTRY.append(UPDATE_STAGE_SECONDS)
+
+OUTBOX_DELAY_SECONDS = Histogram(
+    name="bot_outbox_delay_seconds",
+    documentation="Time from enqueueing a message to its delivery",
+    labelnames=("result",),
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0)
+)
+REGISTRY.append(OUTBOX_DELAY_SECONDS)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+_timings: ContextVar[dict[str, Any] | None] = ContextVar("update_timings", default=None)
+
+
+def current_timings() -> dict[str, Any]:
+    """Счетчики времени текущего апдейта, создаются при первом обращении."""
+    timings = _timings.get()
+    if timings is None:
+        timings = {stage: 0.0 for stage in STAGES}
+        timings["handler"] = None
+        timings["db_queries"] = 0
+        # Ответы апдейта, еще стоящие в очереди MessageSender
+        timings["outgoing"] = 0
+        timings["observed"] = False
+        _timings.set(timings)
+    return timings
+
+
+def reset_timings() -> None:
+    _timings.set(None)
+
+
+def track_outgoing() -> dict[str, Any] | None:
+    """Отмечает ответ текущего апдейта, поставленный в очередь.
+
+    Возвращает счетчики апдейта, их нужно передать в ``bind_timings``
+    в задаче доставки и в ``outgoing_done`` после нее.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings["outgoing"] += 1
+    return timings
+
+
+def bind_timings(timings: dict[str, Any] | None) -> None:
+    """Время запросов к Bot API в текущей задаче идет в счетчики апдейта."""
+    _timings.set(timings)
+
+
+def outgoing_done(timings: dict[str, Any] | None) -> None:
+    """Ответ доставлен или отброшен. После последнего ответа уже
+    обработанного апдейта записывается его этап telegram."""
+    if timings is None:
+        return
+    timings["outgoing"] -= 1
+    if timings["observed"] and not timings["outgoing"]:
+        UPDATE_STAGE_SECONDS.observe(
+            timings["telegram"], handler=timings["handler"] or "unhandled", stage="telegram"
+        )
+
+
+def add_stage_time(stage: str, seconds: float) -> None:
+    current_timings()[stage] += seconds
+
+
+@contextmanager
+def measure(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage, time.perf_counter() - started)
+
+
+def observe_update(timings: dict[str, Any], total: float) -> None:
+    """Записывает этапы апдейта. Этап telegram откладывается, пока
+    ответы апдейта ждут отправки в очереди, см. ``outgoing_done``."""
+    handler = timings["handler"] or "unhandled"
+    timings["observed"] = True
+    for stage in STAGES:
+        if stage == "telegram" and timings["outgoing"]:
+            continue
+        UPDATE_STAGE_SECONDS.observe(timings[stage], handler=handler, stage=stage)
+    UPDATE_STAGE_SECONDS.observe(total, handler=handler, stage="total")
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Считает время и число SQL-запросов текущего апдейта."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        timings = current_timings()
+        timings["db"] += time.perf_counter() - started
+        timings["db_queries"] += 1
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Считает время запросов к Telegram Bot API текущего апдейта."""
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with measure("telegram"):
+            return await make_request(bot, method)
+
+
+class MetricsServer:
+    """Отдает метрики на ``/metrics`` с локального aiohttp-сервера."""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=render_metrics(),
+            content_type="text/plain",
+            charset="utf-8"
+        )
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, handle_signals=False)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=self.host, port=self.port).start()
+        logger.info("Метрики доступны на %s:%s/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
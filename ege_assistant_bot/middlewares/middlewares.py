@@ -1,17 +1,66 @@
+import asyncio
+import time
 from typing import Any, Awaitable, Callable
 
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, TelegramObject
+
+from database.db import SessionRouter
+from config.config import Throttling
+from metrics.metrics import current_timings, measure, observe_update, reset_timings
+from services.throttling import RateLimiter
+from storage.storage import CachedStorage
 
 
 class DBSessionMiddleware(BaseMiddleware):
-    session_pool: async_sessionmaker[AsyncSession]
+    """Передает в хендлер сессию БД.
+
+    AsyncSession берет соединение из пула только при первом запросе,
+    поэтому апдейты без обращений к БД пул не занимают. Хендлеры,
+    зарегистрированные с флагом ``db_session=False``, сессию не
+    получают. Хендлеры с флагом ``db_replica=True`` только читают и
+    получают сессию реплики, остальные - основной БД.
+    """
+    router: SessionRouter
+
+    __slots__ = ("router",)
+
+    def __init__(self, router: SessionRouter) -> None:
+        self.router = router
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if get_flag(data, "db_session", default=True) is False:
+            return await handler(event, data)
+        chat = data.get("event_chat")
+        chat_id = chat.id if chat else None
+        replica = get_flag(data, "db_replica", default=False)
+        if replica:
+            session = self.router.for_read(chat_id)()
+        else:
+            session = self.router.primary()
+        data["session"] = session
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
+            if not replica and chat_id is not None:
+                self.router.mark_written(chat_id)
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Сохраняет накопленные изменения FSM в Redis после обработки апдейта."""
+    storage: CachedStorage
 
-    __slots__ = ("session_pool",)
+    __slots__ = ("storage",)
 
-    def __init__(self, session_pool: async_sessionmaker[AsyncSession]) -> None:
-        self.session_pool = session_pool
+    def __init__(self, storage: CachedStorage) -> None:
+        self.storage = storage
 
     async def __call__(
         self,
@@ -19,6 +68,114 @@ class DBSessionMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data["session"] = session
+        try:
             return await handler(event, data)
+        finally:
+            await self.storage.flush()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Записывает время этапов обработки апдейта в гистограммы."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        # Задача апдейта копирует контекст родителя: если в нем уже есть
+        # счетчики (например, от запросов при старте), они стали бы общими
+        # для всех апдейтов
+        reset_timings()
+        timings = current_timings()
+        timings["started"] = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            total = time.perf_counter() - timings["started"]
+            if timings["handler"] is None:
+                # Ни один хендлер не подошел: все время, кроме ожидания
+                # лимита, ушло на фильтры
+                timings["filters"] = total - timings["throttle"]
+            observe_update(timings, total)
+            reset_timings()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Запоминает выбранный хендлер и время, ушедшее на фильтры.
+
+    Ожидание в ``ThrottlingMiddleware`` идет в свой этап throttle и из
+    времени фильтров вычитается.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        timings = current_timings()
+        timings["handler"] = data["handler"].callback.__name__
+        if "started" in timings:
+            timings["filters"] = (
+                time.perf_counter() - timings["started"] - timings["throttle"]
+            )
+        return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту сообщений от чата и вызовов каждой команды.
+
+    Регистрируется как внешний middleware, чтобы лишние апдейты
+    отбрасывались до фильтров и обращений к БД. Апдейт, которому нужно
+    подождать не дольше ``max_delay``, откладывается, остальные
+    отбрасываются. О превышении лимита пользователь получает одно
+    сообщение, пока корзина не начнет снова наполняться.
+    """
+    limiter: RateLimiter
+    config: Throttling
+
+    __slots__ = ("limiter", "config", "dropped", "delayed")
+
+    def __init__(self, limiter: RateLimiter, config: Throttling) -> None:
+        self.limiter = limiter
+        self.config = config
+        self.dropped = 0
+        self.delayed = 0
+
+    def _buckets(
+            self,
+            message: Message
+    ) -> tuple[tuple[str, ...], tuple[tuple[float, int], ...]]:
+        chat_id = message.chat.id
+        keys = ("throttle:%s" % chat_id,)
+        limits = ((self.config.rate, self.config.burst),)
+        if message.text and message.text.startswith("/"):
+            command = message.text.split(maxsplit=1)[0].split("@", 1)[0]
+            keys += ("throttle:%s:%s" % (chat_id, command),)
+            limits += ((self.config.command_rate, self.config.command_burst),)
+        return keys, limits
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: dict[str, Any],
+    ) -> Any:
+        keys, limits = self._buckets(event)
+        if self.limiter.blocked_for(keys):
+            # Пользователя уже предупредили, в Redis не идем
+            self.dropped += 1
+            return None
+        wait = await self.limiter.acquire(keys, limits)
+        if wait is None:
+            self.dropped += 1
+            await data["sender"].send(
+                event.chat.id, text="Слишком много сообщений, подожди немного"
+            )
+            return None
+        if wait:
+            self.delayed += 1
+            with measure("throttle"):
+                await asyncio.sleep(wait)
+        return await handler(event, data)
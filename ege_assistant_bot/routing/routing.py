@@ -0,0 +1,129 @@
+from typing import Any
+
+from aiogram import Router
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.handler import CallbackType, HandlerObject
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.filters import Filter, StateFilter
+from aiogram.fsm.state import State
+from aiogram.types import Message
+
+# Текст или состояние, которые не упоминаются ни в одном индексе
+OTHER = object()
+
+
+class TextIs(Filter):
+    """Точное совпадение текста сообщения с одним из вариантов.
+
+    В ``IndexedMessageObserver`` не вычисляется, а попадает в индекс.
+    """
+
+    __slots__ = ("texts",)
+
+    def __init__(self, *texts: str) -> None:
+        self.texts = frozenset(texts)
+
+    async def __call__(self, message: Message) -> bool:
+        return message.text in self.texts
+
+
+def _index_states(state_filter: StateFilter) -> frozenset | None:
+    """Состояния фильтра для индекса или None, если его нельзя индексировать."""
+    states = set()
+    for state in state_filter.states:
+        if isinstance(state, State):
+            state = state.state
+        if state == "*" or not (state is None or isinstance(state, str)):
+            return None
+        states.add(state)
+    return frozenset(states)
+
+
+class IndexedMessageObserver(TelegramEventObserver):
+    """Обсервер сообщений, который выбирает хендлеры по словарю.
+
+    Фильтры ``TextIs`` и ``StateFilter`` с конкретными состояниями при
+    регистрации переносятся в индекс по тексту и состоянию. Для
+    апдейта по паре (текст, состояние) из словаря берется заранее
+    собранный список подходящих хендлеров, и только их оставшиеся
+    фильтры проверяются по порядку. Порядок хендлеров и правило
+    "срабатывает первый подошедший" те же, что у обычного обсервера.
+    """
+
+    def __init__(self, router: Router, event_name: str = "message") -> None:
+        super().__init__(router=router, event_name=event_name)
+        self._index: list[tuple[frozenset | None, frozenset | None]] = []
+        self._texts: set[str] = set()
+        self._states: set[str | None] = set()
+        self._routes: dict[tuple[Any, Any], tuple[HandlerObject, ...]] = {}
+
+    @classmethod
+    def install(cls, router: Router) -> "IndexedMessageObserver":
+        """Заменяет обсервер сообщений роутера, пока в нем нет хендлеров."""
+        if router.message.handlers:
+            raise RuntimeError("Message handlers are already registered")
+        observer = cls(router=router)
+        router.message = router.observers["message"] = observer
+        return observer
+
+    def register(
+            self,
+            callback: CallbackType,
+            *filters: CallbackType,
+            flags: dict[str, Any] | None = None,
+            **kwargs: Any
+    ) -> CallbackType:
+        texts = states = None
+        rest = []
+        for item in filters:
+            if isinstance(item, TextIs):
+                texts = item.texts if texts is None else texts & item.texts
+                continue
+            if isinstance(item, StateFilter):
+                item_states = _index_states(item)
+                if item_states is not None:
+                    states = item_states if states is None else states & item_states
+                    continue
+            rest.append(item)
+        super().register(callback, *rest, flags=flags, **kwargs)
+        self._index.append((texts, states))
+        self._texts.update(texts or ())
+        self._states.update(states or ())
+        self._routes.clear()
+        return callback
+
+    def _route(self, text: Any, state: Any) -> tuple[HandlerObject, ...]:
+        handlers = tuple(
+            handler
+            for handler, (texts, states) in zip(self.handlers, self._index)
+            if (texts is None or text in texts) and (states is None or state in states)
+        )
+        self._routes[text, state] = handlers
+        return handlers
+
+    def candidates(self, message: Message, raw_state: str | None) -> tuple[HandlerObject, ...]:
+        # Произвольный текст (имя, баллы) и незнакомые состояния сводятся
+        # к OTHER, поэтому словарь не растет больше числа комбинаций индекса
+        text = message.text if message.text in self._texts else OTHER
+        state = raw_state if raw_state in self._states else OTHER
+        handlers = self._routes.get((text, state))
+        if handlers is None:
+            handlers = self._route(text, state)
+        return handlers
+
+    async def trigger(self, event: Message, **kwargs: Any) -> Any:
+        for handler in self.candidates(event, kwargs.get("raw_state")):
+            kwargs["handler"] = handler
+            result, data = await handler.check(event, **kwargs)
+            if result:
+                kwargs.update(data)
+                try:
+                    wrapped_inner = self.outer_middleware.wrap_middlewares(
+                        self._resolve_middlewares(),
+                        handler.call,
+                    )
+                    return await wrapped_inner(event, kwargs)
+                except SkipHandler:
+                    continue
+
+        return UNHANDLED
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from redis.asyncio import Redis
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from common.jobs import PeriodicJob
+from database.models import Student
+from services.sender import MessageSender
+
+logger = logging.getLogger("bot")
+
+# Скорость идущих рассылок: имя -> "сообщ/с срок_действия". Процессы
+# бота вычитают ее из своего лимита, чтобы вместе не превысить общий
+# лимит Telegram на бота. Запись продлевается, пока рассылка идет, и
+# устаревает сама, если процесс рассылки упал
+RESERVED_RATES_KEY = "broadcast:rates"
+RESERVATION_REFRESH = 5.0
+RESERVATION_TTL = 15.0
+
+RECIPIENTS = select(
+    Student.id,
+    Student.telegram_id
+).where(
+    Student.id > bindparam("last_id")
+).order_by(Student.id).limit(bindparam("limit"))
+
+COUNT_RECIPIENTS = select(
+    func.count()
+).select_from(Student).where(
+    Student.id > bindparam("last_id")
+)
+
+
+async def reserved_rate(redis: Redis) -> float:
+    """Сколько сообщений в секунду сейчас занимают рассылки."""
+    now = time.time()
+    total = 0.0
+    expired = []
+    for name, value in (await redis.hgetall(RESERVED_RATES_KEY)).items():
+        rate, expires_at = map(float, value.split())
+        if expires_at > now:
+            total += rate
+        else:
+            expired.append(name)
+    if expired:
+        await redis.hdel(RESERVED_RATES_KEY, *expired)
+    return total
+
+
+class Broadcast:
+    """Рассылка сообщения всем зарегистрированным студентам.
+
+    Получатели читаются пачками по ``batch_size`` по ключу id, каждая
+    пачка - отдельным коротким запросом: рассылка идет часами, и долгая
+    транзакция мешала бы VACUUM. Получатели передаются в
+    ``MessageSender``. Когда все сообщения пачки отправлены (или
+    отклонены Telegram), в Redis сохраняется последний id студента из
+    нее. Повторный запуск с тем же именем продолжает рассылку с этого
+    места; сообщения незавершенных пачек при этом могут уйти повторно.
+    Пока рассылка идет, ее ``rate`` записан в Redis, и процессы бота
+    на это время снижают свой лимит отправки.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            engine: AsyncEngine,
+            redis: Redis,
+            sender: MessageSender,
+            rate: float,
+            batch_size: int,
+            progress_interval: float,
+            checkpoint_ttl: int
+    ) -> None:
+        self.name = name
+        self._engine = engine
+        self._redis = redis
+        self._sender = sender
+        self._rate = rate
+        self._batch_size = batch_size
+        self._progress_interval = progress_interval
+        self._checkpoint_ttl = checkpoint_ttl
+        self._key = "broadcast:%s" % name
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+
+    async def load_checkpoint(self) -> dict[str, str]:
+        checkpoint = await self._redis.hgetall(self._key)
+        return {key.decode(): value.decode() for key, value in checkpoint.items()}
+
+    async def reset(self) -> None:
+        await self._redis.delete(self._key)
+
+    async def _save_checkpoint(self, **fields: str | int) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key, mapping=fields)
+            pipe.expire(self._key, self._checkpoint_ttl)
+            await pipe.execute()
+
+    async def _reserve_rate(self) -> None:
+        await self._redis.hset(
+            RESERVED_RATES_KEY, self.name, "%s %s" % (self._rate, time.time() + RESERVATION_TTL)
+        )
+
+    async def _fetch(self, last_id: int) -> list:
+        async with self._engine.connect() as connection:
+            result = await connection.execute(
+                RECIPIENTS, {"last_id": last_id, "limit": self._batch_size}
+            )
+            return result.all()
+
+    async def _count(self, last_id: int) -> int:
+        async with self._engine.connect() as connection:
+            result = await connection.execute(COUNT_RECIPIENTS, {"last_id": last_id})
+            return result.scalar_one()
+
+    async def run(self, text: str | None = None) -> None:
+        checkpoint = await self.load_checkpoint()
+        if checkpoint.get("finished"):
+            logger.info("Рассылка %s уже завершена", self.name)
+            return
+        text = text or checkpoint.get("text")
+        if not text:
+            raise ValueError("Не задан текст рассылки %s" % self.name)
+        last_id = int(checkpoint.get("last_id", 0))
+        self.sent = int(checkpoint.get("sent", 0))
+        self.failed = int(checkpoint.get("failed", 0))
+        if checkpoint:
+            logger.info("Рассылка %s продолжается после студента %s", self.name, last_id)
+        await self._save_checkpoint(text=text, last_id=last_id)
+
+        total = await self._count(last_id)
+        logger.info("Рассылка %s: получателей %s", self.name, total)
+        started = time.perf_counter()
+        self.enqueued = 0
+        reporter = asyncio.create_task(self._report_progress(total, started))
+        # Пока рассылка идет, процессы бота отправляют медленнее
+        reservation = PeriodicJob(
+            self._reserve_rate,
+            interval=RESERVATION_REFRESH,
+            error_message="Не удалось продлить лимит рассылки %s" % self.name
+        )
+        await self._reserve_rate()
+        reservation.start()
+        # Пачки в порядке чтения: (последний id, сообщения пачки)
+        batches: deque[tuple[int, list[asyncio.Future]]] = deque()
+
+        async def commit_finished(wait: bool) -> None:
+            nonlocal last_id
+            while batches and (wait or all(done.done() for done in batches[0][1])):
+                batch_last_id, results = batches.popleft()
+                for delivered in await asyncio.gather(*results):
+                    if delivered:
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+                last_id = batch_last_id
+                await self._save_checkpoint(
+                    last_id=last_id, sent=self.sent, failed=self.failed
+                )
+
+        try:
+            fetched_id = last_id
+            while rows := await self._fetch(fetched_id):
+                results = []
+                for student_id, telegram_id in rows:
+                    # send ждет, пока в очереди отправки освободится место
+                    results.append(await self._sender.send(telegram_id, text=text))
+                    self.enqueued += 1
+                fetched_id = rows[-1].id
+                batches.append((fetched_id, results))
+                await commit_finished(wait=False)
+            await commit_finished(wait=True)
+        finally:
+            reporter.cancel()
+            await reservation.stop()
+            await self._redis.hdel(RESERVED_RATES_KEY, self.name)
+        await self._save_checkpoint(finished=1)
+        self._report(total, time.perf_counter() - started)
+        logger.info(
+            "Рассылка %s завершена: доставлено %s, не доставлено %s",
+            self.name, self.sent, self.failed
+        )
+
+    async def _report_progress(self, total: int, started: float) -> None:
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            self._report(total, time.perf_counter() - started)
+
+    def _report(self, total: int, elapsed: float) -> None:
+        delivered = self.enqueued - self._sender.pending
+        rate = delivered / elapsed if elapsed else 0.0
+        remaining = (total - delivered) / rate if rate else 0.0
+        logger.info(
+            "Рассылка %s: отправлено %s из %s, %.1f сообщ/с, осталось ~%.0f с",
+            self.name, delivered, total, rate, remaining
+        )
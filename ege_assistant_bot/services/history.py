@@ -0,0 +1,102 @@
+import logging
+from collections.abc import AsyncIterator
+
+from redis.asyncio import Redis
+from sqlalchemy import Row, bindparam, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from common.jobs import PeriodicJob
+from database.models import Subject, student_score_history
+
+logger = logging.getLogger("bot")
+
+CREATE_PARTITIONS = text("SELECT create_score_history_partitions(:months)")
+
+PARTITIONS_LOCK_KEY = "history:partitions"
+
+# Сколько последних баллов по каждому предмету показывает /history
+HISTORY_LIMIT = 20
+
+# Ответ /history делится на сообщения не длиннее лимита Telegram
+MESSAGE_LIMIT = 4096
+
+# Последние баллы студента по каждому предмету в хронологическом порядке
+_ranked = select(
+    student_score_history.c.subject_id,
+    student_score_history.c.score,
+    student_score_history.c.created_at,
+    func.row_number().over(
+        partition_by=student_score_history.c.subject_id,
+        order_by=student_score_history.c.created_at.desc()
+    ).label("position")
+).where(
+    student_score_history.c.student_id == bindparam("student_id")
+).subquery()
+STUDENT_HISTORY = select(
+    Subject.name,
+    _ranked.c.score,
+    _ranked.c.created_at
+).join(
+    Subject, Subject.id == _ranked.c.subject_id
+).where(
+    _ranked.c.position <= bindparam("limit")
+).order_by(Subject.name, _ranked.c.created_at)
+
+
+def format_trend(subject: str, scores: list[int]) -> str:
+    """Строка вида ``Математика: 45 → 52 → 61 (+16)``."""
+    trend = " → ".join(str(score) for score in scores)
+    if len(scores) < 2:
+        return f"{subject}: {trend}"
+    return f"{subject}: {trend} ({scores[-1] - scores[0]:+d})"
+
+
+async def group_scores(rows: AsyncIterator[Row]) -> AsyncIterator[tuple[str, list[int]]]:
+    """Собирает строки STUDENT_HISTORY в пары (предмет, баллы)."""
+    subject = None
+    scores = []
+    async for name, score, _ in rows:
+        if name != subject and scores:
+            yield subject, scores
+            scores = []
+        subject = name
+        scores.append(score)
+    if scores:
+        yield subject, scores
+
+
+class HistoryPartitionKeeper:
+    """Заранее создает месячные секции student_score_history.
+
+    Вставка в историю без подходящей секции завершится ошибкой, поэтому
+    секции поддерживаются на ``months_ahead`` месяцев вперед. Как и
+    обновление статистики, работу выполняет один процесс из всех реплик.
+    """
+
+    def __init__(
+            self,
+            session_pool: async_sessionmaker[AsyncSession],
+            redis: Redis,
+            months_ahead: int,
+            interval: int
+    ) -> None:
+        self._session_pool = session_pool
+        self._months_ahead = months_ahead
+        self._job = PeriodicJob(
+            self.create_partitions,
+            interval=interval,
+            error_message="Не удалось создать секции истории баллов",
+            redis=redis,
+            lock_key=PARTITIONS_LOCK_KEY
+        )
+
+    async def create_partitions(self) -> None:
+        async with self._session_pool() as session:
+            await session.execute(CREATE_PARTITIONS, {"months": self._months_ahead})
+            await session.commit()
+
+    async def start(self) -> None:
+        self._job.start()
+
+    async def stop(self) -> None:
+        await self._job.stop()
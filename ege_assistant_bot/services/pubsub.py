@@ -0,0 +1,26 @@
+import logging
+from typing import Callable
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger("bot")
+
+
+async def listen_channel(
+        redis: Redis,
+        channel: str,
+        callback: Callable[[bytes], None]
+) -> None:
+    """Вызывает ``callback`` для каждого сообщения из Redis-канала.
+
+    При обрыве подписки пишет ошибку в лог и завершается: кэши,
+    которые ее используют, продолжают обновляться по TTL.
+    """
+    try:
+        async with redis.pubsub() as pubsub:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    callback(message["data"])
+    except Exception:
+        logger.exception("Подписка на канал %s прервана", channel)
@@ -0,0 +1,142 @@
+import logging
+from collections import OrderedDict
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger("bot")
+
+SEQUENCE_KEY = "score_view:seq"
+GENERATION_KEY = "score_view:generation"
+
+# Версия ответа студента - пара "поколение:версия". Поколение меняется
+# при массовом импорте, версия - при записи баллов студента. Обе берутся
+# из одного счетчика и только растут, поэтому старая версия не может
+# совпасть с новой. KEYS: хэш студента, хэш поколения. ARGV: версия из
+# L1 процесса. Возвращает {версия, 1} если L1 актуален, {версия, 2, текст}
+# при попадании в Redis и {версия, 0} при промахе.
+READ_SCRIPT = """
+local entry = redis.call('HMGET', KEYS[1], 'version', 'token', 'text')
+local generation = redis.call('HGET', KEYS[2], 'version') or '0'
+local token = generation .. ':' .. (entry[1] or '0')
+if token == ARGV[1] then
+    return {token, 1}
+end
+if entry[2] == token then
+    return {token, 2, entry[3]}
+end
+return {token, 0}
+"""
+
+# Сохраняет ответ, только если версия не изменилась с момента чтения и
+# истекла задержка после записи: до этого реплика БД может еще не
+# содержать новых баллов. KEYS как у READ_SCRIPT. ARGV: версия, текст,
+# время жизни в секундах. Возвращает 1, если ответ сохранен.
+FILL_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local entry = redis.call('HMGET', KEYS[1], 'version', 'hold')
+local generation = redis.call('HMGET', KEYS[2], 'version', 'hold')
+local token = (generation[1] or '0') .. ':' .. (entry[1] or '0')
+if token ~= ARGV[1] then
+    return 0
+end
+if (tonumber(entry[2]) or 0) > now or (tonumber(generation[2]) or 0) > now then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'token', token, 'text', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Присваивает хэшу новую версию и удаляет сохраненный ответ.
+# KEYS: хэш студента или поколения, счетчик версий. ARGV: задержка
+# заполнения в мс, время жизни в секундах (0 - без ограничения).
+BUMP_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local version = redis.call('INCR', KEYS[2])
+redis.call('HSET', KEYS[1], 'version', version, 'hold', now + tonumber(ARGV[1]))
+redis.call('HDEL', KEYS[1], 'token', 'text')
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return version
+"""
+
+
+class ScoreViewCache:
+    """Кэш готового ответа /view_scores по telegram_id.
+
+    Первый уровень - LRU в памяти процесса, второй - Redis. Запись
+    баллов после commit меняет версию студента, импорт - поколение всех
+    ответов. Ответ из кэша отдается, только если его версия совпадает с
+    текущей, а сохраняется, только если версия не изменилась за время
+    запроса к БД: ответ, собранный до записи, не попадет в кэш после нее.
+    Проверка версии - один вызов Redis, запросов к БД при попадании нет.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            ttl: int,
+            max_size: int,
+            fill_delay: float
+    ) -> None:
+        self._read = redis.register_script(READ_SCRIPT)
+        self._fill = redis.register_script(FILL_SCRIPT)
+        self._bump = redis.register_script(BUMP_SCRIPT)
+        self._ttl = ttl
+        self._max_size = max_size
+        self._fill_delay = round(fill_delay * 1000)
+        self._local: OrderedDict[int, tuple[bytes, str]] = OrderedDict()
+
+    @staticmethod
+    def _key(telegram_id: int) -> str:
+        return "score_view:%s" % telegram_id
+
+    def _remember(self, telegram_id: int, token: bytes, text: str) -> None:
+        self._local[telegram_id] = (token, text)
+        self._local.move_to_end(telegram_id)
+        while len(self._local) > self._max_size:
+            self._local.popitem(last=False)
+
+    async def get(self, telegram_id: int) -> tuple[bytes, str | None]:
+        """Возвращает версию и ответ, None - если ответа нет в кэше.
+
+        Версию нужно передать в ``set`` вместе с собранным ответом.
+        """
+        cached = self._local.get(telegram_id)
+        local_token = cached[0] if cached is not None else b""
+        token, status, *text = await self._read(
+            keys=[self._key(telegram_id), GENERATION_KEY],
+            args=[local_token]
+        )
+        if status == 1:
+            self._local.move_to_end(telegram_id)
+            return token, cached[1]
+        if status == 2:
+            self._remember(telegram_id, token, text[0].decode())
+            return token, text[0].decode()
+        self._local.pop(telegram_id, None)
+        return token, None
+
+    async def set(self, telegram_id: int, token: bytes, text: str) -> None:
+        stored = await self._fill(
+            keys=[self._key(telegram_id), GENERATION_KEY],
+            args=[token, text, self._ttl]
+        )
+        if stored:
+            self._remember(telegram_id, token, text)
+
+    async def invalidate(self, telegram_id: int) -> None:
+        """Вызывается после commit баллов студента."""
+        self._local.pop(telegram_id, None)
+        await self._bump(
+            keys=[self._key(telegram_id), SEQUENCE_KEY],
+            args=[self._fill_delay, self._ttl]
+        )
+
+    async def invalidate_all(self) -> None:
+        """Вызывается после массового изменения баллов."""
+        self._local.clear()
+        await self._bump(keys=[GENERATION_KEY, SEQUENCE_KEY], args=[self._fill_delay, 0])
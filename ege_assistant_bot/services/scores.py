@@ -0,0 +1,150 @@
+import asyncio
+import logging
+
+from sqlalchemy import ARRAY, Integer, bindparam, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.models import StudentScore
+
+logger = logging.getLogger("bot")
+
+# Допустимая сумма баллов, одна для бота и импорта из cli.py
+MIN_SCORE = 1
+MAX_SCORE = 99
+
+
+def is_valid_score(score: int) -> bool:
+    return MIN_SCORE <= score <= MAX_SCORE
+
+
+# Пачка баллов передается тремя массивами: выражение одно для любого
+# размера пачки, asyncpg подготавливает его один раз на соединение.
+# INSERT строится по таблице, а не по модели: для модели Session ушла бы
+# в ORM bulk insert, который не поддерживает INSERT ... SELECT
+_rows = func.unnest(
+    bindparam("student_ids", type_=ARRAY(Integer)),
+    bindparam("subject_ids", type_=ARRAY(Integer)),
+    bindparam("scores", type_=ARRAY(Integer))
+).table_valued("student_id", "subject_id", "score").render_derived()
+_insert_scores = insert(StudentScore.__table__).from_select(
+    ["student_id", "subject_id", "score"],
+    select(_rows.c.student_id, _rows.c.subject_id, _rows.c.score)
+)
+INSERT_STUDENT_SCORES = _insert_scores.on_conflict_do_update(
+    constraint="_student_subject_uc",
+    set_={"score": _insert_scores.excluded.score}
+)
+
+
+class ScoreWriter:
+    """Буфер записи баллов с отложенной пакетной вставкой.
+
+    Баллы копятся ``max_delay`` секунд или до ``max_rows`` строк и
+    записываются одним INSERT ... ON CONFLICT в одной транзакции.
+    ``save`` возвращается только после commit пачки. Если пачка не
+    записалась, строки пишутся по одной, и ошибку получают только
+    хендлеры строк, которые не удалось сохранить. Пачки пишутся по
+    очереди: баллы, пришедшие во время записи, уходят следующей пачкой
+    сразу после нее. Поэтому для одной пары студент-предмет побеждает
+    последний балл.
+    """
+
+    def __init__(
+            self,
+            session_pool: async_sessionmaker[AsyncSession],
+            max_rows: int,
+            max_delay: float
+    ) -> None:
+        self._session_pool = session_pool
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        # (student_id, subject_id) -> [балл, ожидающие хендлеры]
+        self._pending: dict[tuple[int, int], list] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushing: asyncio.Task | None = None
+
+    async def save(self, student_id: int, subject_id: int, score: int) -> None:
+        done = asyncio.get_running_loop().create_future()
+        entry = self._pending.get((student_id, subject_id))
+        if entry is None:
+            self._pending[student_id, subject_id] = [score, [done]]
+        else:
+            entry[0] = score
+            entry[1].append(done)
+        if len(self._pending) >= self._max_rows:
+            self._start_flush()
+        elif self._timer is None and self._flushing is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._max_delay, self._start_flush
+            )
+        await done
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending and self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self) -> None:
+        # Между проверкой и сбросом _flushing нет await: баллы, пришедшие
+        # после последней пачки, запустят новую задачу
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, {}
+                await self._flush(batch)
+        finally:
+            self._flushing = None
+
+    async def _write(self, keys: list[tuple[int, int]], batch: dict[tuple[int, int], list]) -> None:
+        async with self._session_pool() as session:
+            await session.execute(INSERT_STUDENT_SCORES, {
+                "student_ids": [student_id for student_id, _ in keys],
+                "subject_ids": [subject_id for _, subject_id in keys],
+                "scores": [batch[key][0] for key in keys],
+            })
+            await session.commit()
+
+    @staticmethod
+    def _resolve(waiters: list[asyncio.Future], error: Exception | None = None) -> None:
+        for done in waiters:
+            if done.done():
+                continue
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+
+    async def _flush(self, batch: dict[tuple[int, int], list]) -> None:
+        keys = list(batch)
+        try:
+            await self._write(keys, batch)
+        except Exception as error:
+            if len(keys) == 1:
+                logger.exception("Не удалось сохранить балл %s", keys[0])
+                self._resolve(batch[keys[0]][1], error)
+                return
+            # Одна плохая строка (например, id из устаревшего кэша)
+            # откатывает всю пачку: строки пишутся по одной, и ошибку
+            # получает только хендлер строки, которая ее вызвала
+            logger.warning(
+                "Пачка из %s баллов не сохранена (%r), запись по одной", len(keys), error
+            )
+            for key in keys:
+                try:
+                    await self._write([key], batch)
+                except Exception as row_error:
+                    logger.exception("Не удалось сохранить балл %s", key)
+                    self._resolve(batch[key][1], row_error)
+                else:
+                    self._resolve(batch[key][1])
+            return
+        for _, waiters in batch.values():
+            self._resolve(waiters)
+
+    async def close(self) -> None:
+        """Записывает накопленные баллы и дожидается всех пачек."""
+        self._start_flush()
+        if self._flushing is not None:
+            await self._flushing
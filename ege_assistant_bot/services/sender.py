@@ -0,0 +1,231 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from metrics.metrics import (
+    OUTBOX_DELAY_SECONDS,
+    bind_timings,
+    outgoing_done,
+    track_outgoing,
+)
+
+logger = logging.getLogger("bot")
+
+# Больше этого ответы для одного чата не откладываются после сетевых ошибок
+MAX_BACKOFF = 30.0
+
+# Сколько чатов с пустой очередью помнить, чтобы соблюдать паузу между сообщениями
+CHAT_READY_CACHE_SIZE = 10000
+
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    kwargs: dict[str, Any]
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    # Счетчики времени апдейта, который поставил сообщение в очередь
+    timings: dict[str, Any] | None = field(default_factory=track_outgoing)
+    done: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future()
+    )
+
+
+class MessageSender:
+    """Очередь исходящих сообщений с учетом лимитов Telegram.
+
+    Хендлеры ставят ответ в очередь и сразу возвращаются, отправкой
+    занимается фоновая задача. Сообщения одного чата уходят по порядку
+    и не чаще раза в ``chat_interval`` секунд, всего процесс отправляет
+    не больше ``rate`` сообщений в секунду. На 429 отправка
+    приостанавливается на указанное Telegram время, сетевые ошибки и
+    ошибки сервера повторяются с растущей паузой.
+
+    Если в очереди ``max_pending`` сообщений, ``send`` ждет, пока
+    место освободится: так медленный Telegram притормаживает хендлеры,
+    а не копит сообщения в памяти.
+    """
+
+    def __init__(
+            self,
+            rate: float,
+            chat_interval: float,
+            max_pending: int,
+            max_in_flight: int,
+            max_retries: int,
+            shutdown_timeout: float
+    ) -> None:
+        self._interval = 1 / rate
+        self._chat_interval = chat_interval
+        self._max_retries = max_retries
+        self._shutdown_timeout = shutdown_timeout
+        self._slots = asyncio.Semaphore(max_pending)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        # Очереди чатов, у которых есть неотправленные сообщения
+        self._chats: dict[int, deque[OutgoingMessage]] = {}
+        # Когда чату снова можно писать, для чатов с пустой очередью
+        self._chat_ready_at: dict[int, float] = {}
+        # Куча (время готовности, порядковый номер, chat_id)
+        self._ready: list[tuple[float, int, int]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._next_send_at = 0.0
+        self._paused_until = 0.0
+        self._bot: Bot | None = None
+        self._task: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        self.pending = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def set_rate(self, rate: float) -> None:
+        interval = 1 / rate
+        if interval != self._interval:
+            logger.info("Лимит отправки: %.1f сообщ/с", rate)
+            self._interval = interval
+
+    async def send(self, chat_id: int, text: str, **kwargs: Any) -> asyncio.Future:
+        """Ставит сообщение в очередь, параметры как у ``Bot.send_message``.
+
+        Возвращает future, который получит True после доставки сообщения
+        или False, если отправить его не удалось.
+        """
+        await self._slots.acquire()
+        self.pending += 1
+        self._idle.clear()
+        message = OutgoingMessage(chat_id=chat_id, kwargs={"text": text, **kwargs})
+        queue = self._chats.get(chat_id)
+        if queue is not None:
+            queue.append(message)
+            return message.done
+        self._chats[chat_id] = deque((message,))
+        ready_at = self._chat_ready_at.pop(chat_id, 0.0)
+        self._schedule(chat_id, ready_at)
+        return message.done
+
+    def _schedule(self, chat_id: int, ready_at: float) -> None:
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+        self._wakeup.set()
+
+    async def _wait(self, timeout: float | None) -> None:
+        self._wakeup.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+    async def _run(self) -> None:
+        while True:
+            if not self._ready:
+                await self._wait(None)
+                continue
+            ready_at, _, chat_id = self._ready[0]
+            now = time.monotonic()
+            start_at = max(ready_at, self._next_send_at, self._paused_until)
+            if start_at > now:
+                await self._wait(start_at - now)
+                continue
+            heapq.heappop(self._ready)
+            await self._in_flight.acquire()
+            self._next_send_at = max(now, self._next_send_at) + self._interval
+            task = asyncio.create_task(self._deliver(chat_id))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: int) -> None:
+        queue = self._chats[chat_id]
+        message = queue[0]
+        retry_in = None
+        # Задача доставки выполняется вне контекста апдейта: время запроса
+        # к Bot API записывается в этап telegram апдейта-отправителя
+        bind_timings(message.timings)
+        try:
+            await self._bot.send_message(chat_id=chat_id, **message.kwargs)
+            self.sent += 1
+            result = "sent"
+        except TelegramRetryAfter as error:
+            # Лимит общий для бота: останавливаем всю отправку
+            logger.warning("Telegram просит подождать %s с", error.retry_after)
+            self._paused_until = time.monotonic() + error.retry_after
+            retry_in = 0.0
+        except (TelegramNetworkError, TelegramServerError) as error:
+            message.attempts += 1
+            if message.attempts <= self._max_retries:
+                retry_in = min(2 ** message.attempts, MAX_BACKOFF)
+                logger.warning(
+                    "Ошибка отправки в чат %s, повтор через %s с: %s",
+                    chat_id, retry_in, error
+                )
+            else:
+                logger.error("Не удалось отправить сообщение в чат %s: %s", chat_id, error)
+                result = "failed"
+        except TelegramAPIError as error:
+            logger.info("Сообщение в чат %s отклонено: %s", chat_id, error)
+            result = "failed"
+        except Exception:
+            logger.exception("Ошибка отправки сообщения в чат %s", chat_id)
+            result = "failed"
+        finally:
+            self._in_flight.release()
+
+        now = time.monotonic()
+        if retry_in is not None:
+            self.retried += 1
+            self._schedule(chat_id, now + retry_in)
+            return
+        if result == "failed":
+            self.failed += 1
+        OUTBOX_DELAY_SECONDS.observe(now - message.enqueued_at, result=result)
+        outgoing_done(message.timings)
+        message.done.set_result(result == "sent")
+        queue.popleft()
+        self.pending -= 1
+        self._slots.release()
+        ready_at = now + self._chat_interval
+        if queue:
+            self._schedule(chat_id, ready_at)
+            return
+        del self._chats[chat_id]
+        self._remember_ready_at(chat_id, ready_at, now)
+        if not self.pending:
+            self._idle.set()
+
+    def _remember_ready_at(self, chat_id: int, ready_at: float, now: float) -> None:
+        if len(self._chat_ready_at) >= CHAT_READY_CACHE_SIZE:
+            self._chat_ready_at = {
+                chat: at for chat, at in self._chat_ready_at.items() if at > now
+            }
+        self._chat_ready_at[chat_id] = ready_at
+
+    async def start(self, bot: Bot) -> None:
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Дожидается отправки очереди не дольше ``shutdown_timeout``."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), self._shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено %s сообщений при остановке", self.pending)
+        tasks = [self._task, *self._deliveries]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
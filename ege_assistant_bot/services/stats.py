@@ -0,0 +1,59 @@
+import logging
+
+from redis.asyncio import Redis
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from common.jobs import PeriodicJob
+
+logger = logging.getLogger("bot")
+
+REFRESH_STATS = text("REFRESH MATERIALIZED VIEW CONCURRENTLY subject_score_stats")
+
+REFRESH_LOCK_KEY = "stats:refresh"
+
+
+def score_percentile(score: int, score_counts: list[int]) -> float:
+    """Доля участников (в процентах) с баллом ниже ``score``."""
+    students = sum(score_counts)
+    if not students:
+        return 0.0
+    return sum(score_counts[:score]) / students * 100
+
+
+class StatsRefresher:
+    """Периодически обновляет представление subject_score_stats.
+
+    Обновление запускает только один процесс из всех реплик: он
+    захватывает ключ в Redis на время интервала.
+    """
+
+    def __init__(
+            self,
+            session_pool: async_sessionmaker[AsyncSession],
+            redis: Redis,
+            interval: int
+    ) -> None:
+        self._session_pool = session_pool
+        self._job = PeriodicJob(
+            self._refresh_and_log,
+            interval=interval,
+            error_message="Не удалось обновить статистику баллов",
+            redis=redis,
+            lock_key=REFRESH_LOCK_KEY
+        )
+
+    async def refresh(self) -> None:
+        async with self._session_pool() as session:
+            await session.execute(REFRESH_STATS)
+            await session.commit()
+
+    async def _refresh_and_log(self) -> None:
+        await self.refresh()
+        logger.info("Статистика баллов обновлена")
+
+    async def start(self) -> None:
+        self._job.start()
+
+    async def stop(self) -> None:
+        await self._job.stop()
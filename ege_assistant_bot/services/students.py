@@ -0,0 +1,134 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+
+from redis.asyncio import Redis
+from sqlalchemy import bindparam, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from common.jobs import BackgroundTask
+from database.models import Student
+from services.pubsub import listen_channel
+
+logger = logging.getLogger("bot")
+
+STUDENT_IDENTITY_BY_TELEGRAM_ID = select(
+    Student.id,
+    Student.first_name,
+    Student.last_name
+).where(
+    Student.telegram_id == bindparam("telegram_id")
+)
+
+
+@dataclass(frozen=True)
+class StudentIdentity:
+    id: int
+    first_name: str
+    last_name: str
+
+
+class StudentIdentityCache:
+    """Кэш соответствия telegram_id -> студент.
+
+    Первый уровень - LRU в памяти процесса, второй - Redis, общий для
+    всех процессов и реплик. При изменении аккаунта запись удаляется из
+    Redis, а остальные процессы получают сигнал через Redis-канал и
+    удаляют ее из своих L1.
+    """
+
+    def __init__(
+            self,
+            redis: Redis,
+            ttl: int,
+            max_size: int,
+            channel: str
+    ) -> None:
+        self._redis = redis
+        self._ttl = ttl
+        self._max_size = max_size
+        self._channel = channel
+        self._local: OrderedDict[int, tuple[float, StudentIdentity]] = OrderedDict()
+        self._listener = BackgroundTask(
+            lambda: listen_channel(self._redis, self._channel, self._on_evict)
+        )
+
+    @staticmethod
+    def _key(telegram_id: int) -> str:
+        return "student:%s" % telegram_id
+
+    def _remember(self, telegram_id: int, identity: StudentIdentity) -> None:
+        self._local[telegram_id] = (time.monotonic() + self._ttl, identity)
+        self._local.move_to_end(telegram_id)
+        while len(self._local) > self._max_size:
+            self._local.popitem(last=False)
+
+    async def get(self, telegram_id: int) -> StudentIdentity | None:
+        cached = self._local.get(telegram_id)
+        if cached is not None:
+            expires_at, identity = cached
+            if expires_at > time.monotonic():
+                self._local.move_to_end(telegram_id)
+                return identity
+            del self._local[telegram_id]
+        value = await self._redis.get(self._key(telegram_id))
+        if value is None:
+            return None
+        identity = StudentIdentity(**json.loads(value))
+        self._remember(telegram_id, identity)
+        return identity
+
+    async def set(self, telegram_id: int, identity: StudentIdentity) -> None:
+        self._remember(telegram_id, identity)
+        await self._redis.set(
+            self._key(telegram_id),
+            json.dumps(asdict(identity)),
+            ex=self._ttl
+        )
+
+    async def resolve(
+            self,
+            telegram_id: int,
+            session: AsyncSession
+    ) -> StudentIdentity | None:
+        """Берет студента из кэша, а при промахе - из БД с записью в кэш."""
+        identity = await self.get(telegram_id)
+        if identity is not None:
+            return identity
+        result = await session.execute(
+            STUDENT_IDENTITY_BY_TELEGRAM_ID, {"telegram_id": telegram_id}
+        )
+        row = result.one_or_none()
+        if row is None:
+            return None
+        identity = StudentIdentity(
+            id=row.id,
+            first_name=row.first_name,
+            last_name=row.last_name
+        )
+        await self.set(telegram_id, identity)
+        return identity
+
+    async def evict(self, *telegram_ids: int) -> None:
+        """Удаляет записи во всех процессах после изменения аккаунтов."""
+        if not telegram_ids:
+            return
+        for telegram_id in telegram_ids:
+            self._local.pop(telegram_id, None)
+        await self._redis.delete(*(self._key(telegram_id) for telegram_id in telegram_ids))
+        await self._redis.publish(
+            self._channel,
+            ",".join(str(telegram_id) for telegram_id in telegram_ids)
+        )
+
+    def _on_evict(self, message: bytes) -> None:
+        for telegram_id in message.decode().split(","):
+            self._local.pop(int(telegram_id), None)
+
+    async def start(self) -> None:
+        self._listener.start()
+
+    async def stop(self) -> None:
+        await self._listener.stop()
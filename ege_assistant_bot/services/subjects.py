@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+from redis.asyncio import Redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from common.jobs import BackgroundTask
+from database.models import Subject
+from services.pubsub import listen_channel
+
+logger = logging.getLogger("bot")
+
+
+def create_subjects_keyboard(subjects):
+    return [[KeyboardButton(text=f"{subject.name}")] for subject in subjects]
+
+
+async def get_subjects(session: AsyncSession):
+    stmt = select(Subject)
+    result = await session.scalars(stmt)
+    return result.all()
+
+
+async def publish_invalidation(redis: Redis, channel: str) -> None:
+    """Сообщает всем процессам бота, что справочник предметов изменился."""
+    await redis.publish(channel, "invalidate")
+
+
+class SubjectCatalog:
+    """Справочник предметов в памяти процесса.
+
+    Загружается один раз при старте и перечитывается из БД по истечении TTL
+    или после сообщения в Redis-канал инвалидации.
+    """
+
+    def __init__(
+            self,
+            session_pool: async_sessionmaker[AsyncSession],
+            ttl: float
+    ) -> None:
+        self._session_pool = session_pool
+        self._ttl = ttl
+        self._ids: dict[str, int] = {}
+        self._keyboard: ReplyKeyboardMarkup | None = None
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+        self._listener: BackgroundTask | None = None
+
+    @property
+    def is_stale(self) -> bool:
+        return (
+            self._loaded_at is None
+            or time.monotonic() - self._loaded_at > self._ttl
+        )
+
+    async def load(self) -> None:
+        async with self._session_pool() as session:
+            subjects = await get_subjects(session)
+        self._ids = {subject.name: subject.id for subject in subjects}
+        self._keyboard = ReplyKeyboardMarkup(
+            keyboard=create_subjects_keyboard(subjects),
+            resize_keyboard=True,
+            one_time_keyboard=True
+        )
+        self._loaded_at = time.monotonic()
+        logger.info("Справочник предметов загружен: %s шт.", len(self._ids))
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+
+    async def _refresh_if_stale(self) -> None:
+        if not self.is_stale:
+            return
+        async with self._lock:
+            if self.is_stale:
+                await self.load()
+
+    async def get_keyboard(self) -> ReplyKeyboardMarkup:
+        await self._refresh_if_stale()
+        return self._keyboard
+
+    async def get_id(self, name: str) -> int | None:
+        await self._refresh_if_stale()
+        return self._ids.get(name)
+
+    def _on_invalidate(self, message: bytes) -> None:
+        logger.info("Получен сигнал сброса справочника предметов")
+        self.invalidate()
+
+    async def start(self, redis: Redis, channel: str) -> None:
+        await self.load()
+        self._listener = BackgroundTask(
+            lambda: listen_channel(redis, channel, self._on_invalidate)
+        )
+        self._listener.start()
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            await self._listener.stop()
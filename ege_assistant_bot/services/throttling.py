@@ -0,0 +1,95 @@
+import time
+
+from redis.asyncio import Redis
+
+# Проверяет все корзины из KEYS и списывает по токену, только если каждая
+# укладывается в допустимое ожидание. ARGV: допустимое ожидание (сек),
+# затем пары скорость/емкость для каждого ключа. Время берется у Redis,
+# чтобы расхождение часов между репликами не влияло на лимиты.
+# Токены могут уйти в минус: так отложенные апдейты занимают место в
+# очереди и следующие ждут дольше. Возвращает {разрешено, ожидание в мс}.
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local max_wait = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(0, now - ts) * rate)
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+end
+if wait > max_wait then
+    return {0, math.ceil(wait * 1000)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil((burst - tokens[i] + 1) / rate * 1000) + 1000)
+end
+return {1, math.ceil(wait * 1000)}
+"""
+
+
+class RateLimiter:
+    """Ограничитель частоты запросов на токен-корзинах в Redis.
+
+    Корзины общие для всех процессов и реплик. Отказ Redis запоминается
+    в памяти процесса: пока корзина пуста, повторные запросы по тем же
+    ключам отклоняются без обращения к Redis.
+    """
+
+    def __init__(self, redis: Redis, max_delay: float, max_size: int) -> None:
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self._max_delay = max_delay
+        self._max_size = max_size
+        self._blocked: dict[tuple[str, ...], float] = {}
+
+    def blocked_for(self, keys: tuple[str, ...]) -> float:
+        """Сколько секунд корзины еще пусты по данным этого процесса."""
+        blocked_until = self._blocked.get(keys)
+        if blocked_until is None:
+            return 0.0
+        remaining = blocked_until - time.monotonic()
+        if remaining <= 0:
+            del self._blocked[keys]
+            return 0.0
+        return remaining
+
+    def _block(self, keys: tuple[str, ...], seconds: float) -> None:
+        now = time.monotonic()
+        if len(self._blocked) >= self._max_size:
+            self._blocked = {
+                key: until for key, until in self._blocked.items() if until > now
+            }
+            if len(self._blocked) >= self._max_size:
+                return
+        self._blocked[keys] = now + seconds
+
+    async def acquire(
+            self,
+            keys: tuple[str, ...],
+            limits: tuple[tuple[float, int], ...]
+    ) -> float | None:
+        """Списывает по токену из каждой корзины.
+
+        Возвращает, сколько секунд подождать перед обработкой, или None,
+        если запрос нужно отбросить.
+        """
+        args = [self._max_delay]
+        for rate, burst in limits:
+            args.extend((rate, burst))
+        allowed, wait_ms = await self._script(keys=keys, args=args)
+        wait = wait_ms / 1000
+        if not allowed:
+            self._block(keys, wait - self._max_delay)
+            return None
+        return wait
@@ -0,0 +1,294 @@
+import inspect
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.asyncio import Redis
+
+from metrics.metrics import measure
+
+logger = logging.getLogger("bot")
+
+
+class PipelinedRedisStorage(RedisStorage):
+    """RedisStorage, умеющий записать состояние и данные одной транзакцией."""
+
+    async def set_state_and_data(
+            self,
+            key: StorageKey,
+            state: StateType,
+            data: dict[str, Any]
+    ) -> None:
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if state is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(
+                    state_key,
+                    state.state if isinstance(state, State) else state,
+                    ex=self.state_ttl
+                )
+            if not data:
+                pipe.delete(data_key)
+            else:
+                pipe.set(data_key, self.json_dumps(data), ex=self.data_ttl)
+            await pipe.execute()
+
+
+@dataclass
+class _Entry:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+
+
+class CachedStorage(BaseStorage):
+    """FSM-хранилище с LRU-кэшем в памяти процесса перед RedisStorage.
+
+    Чтения обслуживаются из кэша, промах загружает состояние и данные
+    чата одним пайплайном. Изменения копятся в памяти и уходят в Redis
+    одной транзакцией при вызове ``flush`` (после каждого апдейта).
+
+    Кэш корректен, только если апдейты одного чата обрабатывает один
+    процесс: один процесс бота или шардирование по чатам (WORKERS).
+    """
+
+    def __init__(self, storage: RedisStorage, max_size: int) -> None:
+        self.storage = storage
+        self.max_size = max_size
+        self._entries: OrderedDict[StorageKey, _Entry] = OrderedDict()
+        self._dirty: dict[StorageKey, _Entry] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def redis(self) -> Redis:
+        return self.storage.redis
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _remember(self, key: StorageKey, entry: _Entry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            # Вытесненная запись с несохраненными изменениями
+            # остается в self._dirty до ближайшего flush
+            self._entries.popitem(last=False)
+
+    async def _load(self, key: StorageKey) -> _Entry:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.storage.key_builder.build(key, "state"))
+            pipe.get(self.storage.key_builder.build(key, "data"))
+            state, data = await pipe.execute()
+        if isinstance(state, bytes):
+            state = state.decode("utf-8")
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return _Entry(
+            state=state,
+            data=self.storage.json_loads(data) if data is not None else {}
+        )
+
+    async def _get_entry(self, key: StorageKey) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        entry = self._dirty.get(key)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = await self._load(key)
+        self._remember(key, entry)
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._get_entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._dirty[key] = entry
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        entry = await self._get_entry(key)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        entry = await self._get_entry(key)
+        entry.data = dict(data)
+        self._dirty[key] = entry
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        entry = await self._get_entry(key)
+        return dict(entry.data)
+
+    async def set_state_and_data(
+            self,
+            key: StorageKey,
+            state: StateType,
+            data: dict[str, Any]
+    ) -> None:
+        # Запись перезаписывается целиком, загружать ее из Redis не нужно
+        entry = self._entries.get(key) or self._dirty.get(key) or _Entry()
+        entry.state = state.state if isinstance(state, State) else state
+        entry.data = dict(data)
+        self._remember(key, entry)
+        self._dirty[key] = entry
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        key_builder = self.storage.key_builder
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                for key, entry in dirty.items():
+                    state_key = key_builder.build(key, "state")
+                    data_key = key_builder.build(key, "data")
+                    if entry.state is None:
+                        pipe.delete(state_key)
+                    else:
+                        pipe.set(state_key, entry.state, ex=self.storage.state_ttl)
+                    if not entry.data:
+                        pipe.delete(data_key)
+                    else:
+                        pipe.set(
+                            data_key,
+                            self.storage.json_dumps(entry.data),
+                            ex=self.storage.data_ttl
+                        )
+                await pipe.execute()
+        except Exception:
+            # Вернем изменения, чтобы записать их при следующем flush
+            for key, entry in dirty.items():
+                self._dirty.setdefault(key, entry)
+            raise
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            logger.info(
+                "FSM-кэш: попаданий %s, промахов %s, hit rate %.2f",
+                self.hits, self.misses, self.hit_rate
+            )
+            await self.storage.close()
+
+
+class TimedStorage(BaseStorage):
+    """Обертка над FSM-хранилищем, которая считает время его вызовов.
+
+    Время попадает в этап ``fsm`` метрик текущего апдейта. Остальные
+    методы вложенного хранилища (``flush``, ``set_state_and_data``)
+    доступны через обертку и тоже замеряются.
+    """
+
+    def __init__(self, storage: BaseStorage) -> None:
+        self.storage = storage
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.storage, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        async def timed(*args: Any, **kwargs: Any) -> Any:
+            with measure("fsm"):
+                return await attr(*args, **kwargs)
+
+        return timed
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        with measure("fsm"):
+            await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        with measure("fsm"):
+            return await self.storage.get_state(key)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        with measure("fsm"):
+            await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        with measure("fsm"):
+            return await self.storage.get_data(key)
+
+    async def update_data(self, key: StorageKey, data: dict[str, Any]) -> dict[str, Any]:
+        with measure("fsm"):
+            return await self.storage.update_data(key, data)
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+_UNSET: Any = object()
+
+
+class FSMBatch:
+    """Копит изменения FSM-контекста и записывает их одной транзакцией.
+
+    Пример::
+
+        async with FSMBatch(state) as batch:
+            batch.clear()
+            batch.update_data(login=True)
+
+    Между очисткой и записью новых данных нет промежутка, в котором
+    другой апдейт увидел бы пустой контекст. Текущие состояние и данные
+    читаются только если батч их не перезаписывает целиком.
+    """
+
+    def __init__(self, context: FSMContext) -> None:
+        self.context = context
+        self._state: StateType = _UNSET
+        self._data: dict[str, Any] | None = None
+        self._updates: dict[str, Any] = {}
+
+    def clear(self) -> None:
+        self._state = None
+        self._data = {}
+        self._updates = {}
+
+    def set_state(self, state: StateType = None) -> None:
+        self._state = state
+
+    def set_data(self, data: dict[str, Any]) -> None:
+        self._data = dict(data)
+        self._updates = {}
+
+    def update_data(self, data: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        if data:
+            self._updates.update(data)
+        self._updates.update(kwargs)
+
+    async def commit(self) -> None:
+        state = self._state
+        if state is _UNSET:
+            state = await self.context.get_state()
+        data = self._data
+        if data is None:
+            data = await self.context.get_data()
+        data = {**data, **self._updates}
+
+        storage = self.context.storage
+        if hasattr(storage, "set_state_and_data"):
+            await storage.set_state_and_data(self.context.key, state, data)
+        else:
+            await storage.set_state(self.context.key, state)
+            await storage.set_data(self.context.key, data)
+
+    async def __aenter__(self) -> "FSMBatch":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            await self.commit()
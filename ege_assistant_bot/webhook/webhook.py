@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import signal
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config.config import Config
+
+logger = logging.getLogger("bot")
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука с ограничением параллельности и мягкой остановкой.
+
+    Апдейты обрабатываются в фоне, но не больше ``max_concurrency``
+    одновременно. При остановке новые запросы получают 503 (Telegram
+    повторит их позже, в том числе на другую реплику), а уже принятые
+    апдейты дообрабатываются в течение ``shutdown_timeout`` секунд.
+    """
+
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            bot: Bot,
+            secret_token: str | None,
+            max_concurrency: int,
+            shutdown_timeout: float,
+            **data: Any
+    ) -> None:
+        super().__init__(
+            dispatcher=dispatcher,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=secret_token,
+            **data
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._shutdown_timeout = shutdown_timeout
+        self._closing = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._closing:
+            return web.Response(text="Shutting down", status=503)
+        return await super().handle(request)
+
+    __call__ = handle
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot=bot, update=update)
+
+    async def drain(self) -> None:
+        self._closing = True
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info("Ожидание обработки %s апдейтов перед остановкой", len(tasks))
+        _, pending = await asyncio.wait(tasks, timeout=self._shutdown_timeout)
+        if pending:
+            logger.warning("Не дождались обработки %s апдейтов", len(pending))
+            for task in pending:
+                task.cancel()
+
+    async def close(self) -> None:
+        # Сессию бота не закрываем: shutdown диспетчера еще отправляет
+        # накопленные ответы, сессия закрывается в on_cleanup приложения
+        await self.drain()
+
+
+def create_app(bot: Bot, dispatcher: Dispatcher, config: Config) -> web.Application:
+    app = web.Application()
+    request_handler = BoundedRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        secret_token=config.webhook.secret,
+        max_concurrency=config.webhook.max_concurrency,
+        shutdown_timeout=config.webhook.shutdown_timeout
+    )
+    # Регистрируем до setup_application, чтобы апдейты дообработались
+    # раньше, чем сработает shutdown диспетчера
+    request_handler.register(app, path=config.webhook.path)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def close_bot_session(app: web.Application) -> None:
+        await bot.session.close()
+
+    # on_cleanup выполняется после всех on_shutdown, в том числе после
+    # остановки MessageSender
+    app.on_cleanup.append(close_bot_session)
+    return app
+
+
+async def run_webhook(
+        bot: Bot,
+        dispatcher: Dispatcher,
+        config: Config,
+        allowed_updates: list[str] | None = None
+) -> None:
+    # Входной процесс шардирования не регистрирует хендлеры, поэтому
+    # передает типы апдейтов сам. По умолчанию - типы из хендлеров
+    if allowed_updates is None:
+        allowed_updates = dispatcher.resolve_used_update_types()
+    await bot.set_webhook(
+        url=config.webhook.create_url(),
+        secret_token=config.webhook.secret,
+        allowed_updates=allowed_updates,
+        drop_pending_updates=config.tg_bot.drop_pending_updates
+    )
+    app = create_app(bot=bot, dispatcher=dispatcher, config=config)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host=config.webhook.host, port=config.webhook.port)
+    await site.start()
+    logger.info(
+        "Вебхук запущен на %s:%s%s",
+        config.webhook.host, config.webhook.port, config.webhook.path
+    )
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка вебхука")
+        await runner.cleanup()
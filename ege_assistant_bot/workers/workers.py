@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from dataclasses import replace
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Chat, TelegramObject, Update, User
+
+from common.jobs import PeriodicJob
+from common.speedups import create_bot_session, run
+from config.config import Config, get_config, setup_logging
+from dispatcher.dispatcher import create_dispatcher, resolve_update_types
+from webhook.webhook import run_webhook
+
+logger = logging.getLogger("bot")
+
+# Сигнал процессу-обработчику, что апдейтов больше не будет
+STOP = None
+# Как часто входной процесс проверяет обработчики, сек
+SUPERVISE_INTERVAL = 1.0
+# Обработчик, упавший раньше этого срока после запуска, перезапускается
+# не сразу, чтобы не запускать процессы в цикле, сек
+RESTART_DELAY = 5.0
+
+
+class UpdateSharder(BaseMiddleware):
+    """Раскладывает апдейты по очередям процессов по ``chat.id``.
+
+    Все апдейты одного чата попадают в один процесс, поэтому шаги
+    FSM-сценариев одного пользователя не выполняются параллельно.
+    Хендлеры входного диспетчера не вызываются.
+    """
+
+    def __init__(self, queues: list[Queue]) -> None:
+        self._queues = queues
+
+    def shard_for(self, key: int) -> int:
+        return key % len(self._queues)
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: dict[str, Any],
+    ) -> None:
+        event_chat: Chat | None = data.get("event_chat")
+        event_from_user: User | None = data.get("event_from_user")
+        if event_chat is not None:
+            key = event_chat.id
+        elif event_from_user is not None:
+            key = event_from_user.id
+        else:
+            key = event.update_id
+        raw = event.model_dump(mode="json", exclude_unset=True, by_alias=True)
+        self._queues[self.shard_for(key)].put((key, raw))
+
+
+class ChatOrderedFeeder:
+    """Обрабатывает апдейты разных чатов параллельно, а одного чата - по очереди."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot) -> None:
+        self._dispatcher = dispatcher
+        self._bot = bot
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def _feed(self, key: int, raw: dict[str, Any]) -> None:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._pending[key] = self._pending.get(key, 0) + 1
+        try:
+            # asyncio.Lock будит ожидающих в порядке очереди,
+            # а задачи стартуют в порядке создания
+            async with lock:
+                await self._dispatcher.feed_raw_update(bot=self._bot, update=raw)
+        finally:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+                del self._locks[key]
+
+    def feed(self, key: int, raw: dict[str, Any]) -> None:
+        task = asyncio.create_task(self._feed(key, raw))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def wait(self) -> None:
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+
+async def _run_worker(index: int, queue: Queue) -> None:
+    # Каждый обработчик отдает метрики на своем порту
+    config = get_config()
+    config = replace(config, metrics=replace(config.metrics, port=config.metrics.port + index + 1))
+    bot = Bot(token=config.tg_bot.token, session=create_bot_session(config.speedups))
+    dispatcher = await create_dispatcher(config)
+    feeder = ChatOrderedFeeder(dispatcher=dispatcher, bot=bot)
+    loop = asyncio.get_running_loop()
+
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+    logger.info("Обработчик %s запущен", index)
+    try:
+        while (item := await loop.run_in_executor(None, queue.get)) is not STOP:
+            feeder.feed(*item)
+        await feeder.wait()
+    finally:
+        try:
+            await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+        finally:
+            await bot.session.close()
+        logger.info("Обработчик %s остановлен", index)
+
+
+def worker_main(index: int, queue: Queue) -> None:
+    # Остановкой управляет входной процесс через STOP в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    config = get_config()
+    setup_logging(config)
+    run(_run_worker(index, queue), config.speedups)
+
+
+class WorkerPool:
+    """Процессы-обработчики и их очереди.
+
+    Входной процесс раз в ``SUPERVISE_INTERVAL`` проверяет обработчики и
+    перезапускает упавший с той же очередью: апдейты его чатов копятся в
+    ней и обрабатываются новым процессом. Теряются только апдейты, которые
+    обрабатывались в момент падения.
+    """
+
+    def __init__(self, count: int) -> None:
+        self._context = multiprocessing.get_context("spawn")
+        self.queues: list[Queue] = [self._context.Queue() for _ in range(count)]
+        self._processes: list[BaseProcess] = []
+        self._started_at: list[float] = []
+        self._supervisor = PeriodicJob(
+            self._supervise,
+            interval=SUPERVISE_INTERVAL,
+            error_message="Не удалось проверить процессы-обработчики",
+            delay_first=True
+        )
+
+    def _spawn(self, index: int) -> BaseProcess:
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, self.queues[index]),
+            name=f"bot-worker-{index}",
+            daemon=False
+        )
+        process.start()
+        return process
+
+    def start(self) -> None:
+        self._processes = [self._spawn(index) for index in range(len(self.queues))]
+        self._started_at = [time.monotonic()] * len(self._processes)
+        self._supervisor.start()
+
+    async def _supervise(self) -> None:
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            if time.monotonic() - self._started_at[index] < RESTART_DELAY:
+                continue
+            logger.error(
+                "Процесс %s завершился с кодом %s, перезапуск",
+                process.name, process.exitcode
+            )
+            process.close()
+            self._processes[index] = self._spawn(index)
+            self._started_at[index] = time.monotonic()
+
+    async def stop(self, timeout: float) -> None:
+        await self._supervisor.stop()
+        loop = asyncio.get_running_loop()
+        for queue in self.queues:
+            queue.put(STOP)
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning("Процесс %s не завершился вовремя", process.name)
+                process.terminate()
+
+
+async def run_sharded(bot: Bot, config: Config) -> None:
+    """Запускает входной процесс и ``config.workers.count`` обработчиков.
+
+    Входной процесс получает апдейты через polling или вебхук и только
+    раскладывает их по очередям, хендлеры выполняются в обработчиках.
+    """
+    workers = WorkerPool(config.workers.count)
+    workers.start()
+    ingress = Dispatcher(disable_fsm=True)
+    ingress.update.outer_middleware(UpdateSharder(workers.queues))
+    try:
+        if config.webhook.enabled:
+            await run_webhook(
+                bot=bot,
+                dispatcher=ingress,
+                config=config,
+                allowed_updates=resolve_update_types(config)
+            )
+        else:
+            await bot.delete_webhook(
+                drop_pending_updates=config.tg_bot.drop_pending_updates
+            )
+            # Без задач на каждый апдейт, чтобы сохранить порядок в очередях
+            await ingress.start_polling(
+                bot,
+                handle_as_tasks=False,
+                allowed_updates=resolve_update_types(config)
+            )
+    finally:
+        await workers.stop(config.workers.shutdown_timeout)
@@ -4,6 +4,5 @@ set -o errexit
 set -o pipefail
 set -o nounset
 
-alembic -c /bot/ege_assistant_bot/config/alembic.ini upgrade head
-
+# Миграции применяет сам бот, если схема БД отстает от кода
 python /bot/ege_assistant_bot/main.py
\ No newline at end of file